@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Benchmarks of the preprocessing and evaluation pipeline on a synthetic,
+# MIND-shaped dataset (see synthetic_mind.py). Every stage is timed (wall and
+# CPU time) and its peak RSS is recorded; the results of a run are appended
+# to a JSON file, so runs of different commits or scales can be compared.
+#
+#   python benchmarks/run_benchmarks.py --scale small
+#   python benchmarks/run_benchmarks.py --users 200000 --articles 50000 --sessions 1000000
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+for path in ("benchmarks", "preprocessing", os.path.join("modelling", "RNN"),
+             os.path.join("modelling", "neural_CF")):
+    sys.path.append(os.path.join(ROOT, path))
+
+from synthetic_mind import write_dataset
+from preprocessingHelper import (import_news, read_behaviors_chunks, article_remap_table,
+                                 remap_articles, clean_behaviors_chunk, user_article_interactions)
+from interactionHelper import build_interaction_matrix
+from dedupHelper import add_near_duplicate_ids
+from samplingHelper import sample_negatives
+import RNNHelper
+from RNNHelper import encode_articles, create_pos_neg, create_test_candidates, evaluate_sessions
+from NCFHelper import evaluate_ratings
+from profilingHelper import profiler, configure, stage, log
+
+# the RNN helpers' progress output is silenced with --quiet, too
+RNNHelper.log = log
+
+SCALES = {'tiny': {'users': 2_000, 'articles': 1_000, 'sessions': 10_000},
+          'small': {'users': 20_000, 'articles': 10_000, 'sessions': 100_000},
+          'medium': {'users': 100_000, 'articles': 30_000, 'sessions': 500_000},
+          'large': {'users': 700_000, 'articles': 100_000, 'sessions': 2_000_000}}
+
+
+# ## Measurement
+# Every stage runs within a stage of the profiler (see profilingHelper.py),
+# which measures wall/CPU time and the peak RSS of the stage. Stages of the
+# helpers themselves show up as nested stages.
+
+class Benchmark:
+
+    def run(self, name, func, *args, rows=None, **kwargs):
+        # `rows` is the number of input rows (or a function of the result)
+        with stage(name, rows=None if callable(rows) else rows) as record:
+            result = func(*args, **kwargs)
+            if callable(rows):
+                record.rows = rows(result)
+
+        return result
+
+    @property
+    def stages(self):
+        return profiler.report()
+
+
+# ## Dummy models
+# The evaluation stages only measure the evaluation code itself, so the
+# trained keras models are replaced by random embeddings with the same
+# predict interface.
+
+class DotProductModel:
+    # stands in for the NCF/GMF models: score(user, item) = <p_u, q_i>
+
+    def __init__(self, n_users, n_items, dim=32, random_seed=None):
+        rng = np.random.default_rng(random_seed)
+        self.user_emb = rng.standard_normal((n_users, dim), dtype=np.float32)
+        self.item_emb = rng.standard_normal((n_items, dim), dtype=np.float32)
+
+    def predict(self, inputs, batch_size=None, verbose=0):
+        users, items = inputs
+        return np.einsum('ij,ij->i', self.user_emb[users], self.item_emb[items])[:, None]
+
+
+class TrajectoryModel:
+    # stands in for the LSTM/GRU models: score = <mean(history), last article>
+
+    def __init__(self, n_articles, dim=32, random_seed=None):
+        rng = np.random.default_rng(random_seed)
+        self.article_emb = rng.standard_normal((n_articles, dim), dtype=np.float32)
+
+    def predict(self, trajectories, batch_size=None, verbose=0):
+        emb = self.article_emb[trajectories]
+        return np.einsum('ij,ij->i', emb[:, :-1].mean(axis=1), emb[:, -1])[:, None]
+
+
+# ## Stages
+
+def load(news_path, behaviors_path, chunksize):
+    news = import_news(news_path)
+    behaviors = pd.concat(read_behaviors_chunks(behaviors_path, chunksize=chunksize),
+                          ignore_index=True)
+    return news, behaviors
+
+
+def dedup_remap(news, behaviors):
+    article_index, canonical_codes = article_remap_table(news)
+    # the token level remapping of both columns as nested stages (items are tokens)
+    for name, strings, labelled in (('remap_history', behaviors.history.dropna(), False),
+                                    ('remap_impressions', behaviors.impressions, True)):
+        with stage(name, rows=len(strings)) as record:
+            _, codes, *_ = remap_articles(strings, article_index, canonical_codes, labelled=labelled)
+            record.items = len(codes)
+    return article_index, canonical_codes
+
+
+def encode(behaviors, n_hist_articles):
+    # RNN preprocessing: sessions with clicked and not clicked impressions
+    clicks = behaviors.impressions.str.count('-1')
+    sessions = behaviors[(clicks > 0) & (clicks < behaviors.impressions.str.count('-'))
+                         & (behaviors.length_history >= n_hist_articles)].copy()
+    sessions['history_split'] = sessions.history.str.split(' ')
+    sessions['impressions_split'] = sessions.impressions.str.split(' ')
+    return encode_articles(sessions)
+
+
+def run_pipeline(data_dir, args, bench):
+    news_path = os.path.join(data_dir, 'news.tsv')
+    behaviors_path = os.path.join(data_dir, 'behaviors.tsv')
+
+    news, behaviors = bench.run('load', load, news_path, behaviors_path, args.chunksize,
+                                rows=lambda r: len(r[1]))
+    if args.near_duplicate_threshold > 0:
+        news = bench.run('near_duplicates', add_near_duplicate_ids, news,
+                         threshold=args.near_duplicate_threshold, rows=len(news))
+    article_index, canonical_codes = bench.run('dedup_remap', dedup_remap, news, behaviors,
+                                               rows=len(behaviors))
+    cleaned = bench.run('filter', clean_behaviors_chunk, behaviors, article_index, canonical_codes,
+                        min_history=args.min_history, rows=len(behaviors))
+    del behaviors
+
+    # collaborative filtering: first session of every user
+    behaviors_cf = cleaned.drop_duplicates(subset='user_id')
+    uai_train_df, uai_test_df = bench.run('interactions', user_article_interactions, behaviors_cf,
+                                          rows=len(behaviors_cf))
+    train_matrix = bench.run('matrix_build', build_interaction_matrix,
+                             uai_train_df.user_int_id.to_numpy(), uai_train_df.article_int_id.to_numpy(),
+                             rows=len(uai_train_df))
+    test_negatives = bench.run('negative_sampling', sample_negatives, train_matrix,
+                               uai_test_df.user_int_id.to_numpy(), args.num_negatives,
+                               seed=args.seed, rows=len(uai_test_df))
+    test_positives = uai_test_df[['user_int_id', 'article_int_id']].to_numpy()
+    model = DotProductModel(*train_matrix.shape, random_seed=args.seed)
+    bench.run('evaluate_ncf', evaluate_ratings, model, test_positives, test_negatives,
+              rows=len(test_positives))
+
+    # RNN: trajectories of all sessions
+    encoded, _, num_articles, _ = bench.run('encode', encode, cleaned, args.n_hist_articles,
+                                            rows=len(cleaned))
+    bench.run('pos_neg', create_pos_neg, encoded, n_hist_articles=args.n_hist_articles,
+              npratio=args.npratio, random_seed=args.seed, rows=len(encoded))
+
+    test = encoded.iloc[:args.test_sessions]
+    positives = test.impressions_int_1.str[0].to_numpy()
+    candidates = bench.run('test_candidates', create_test_candidates, test.history_int.tolist(),
+                           positives, num_articles, n_hist_articles=args.n_hist_articles,
+                           num_test_negs=args.num_negatives, random_seed=args.seed,
+                           workers=args.workers, rows=len(test))
+    model = TrajectoryModel(num_articles, random_seed=args.seed)
+    bench.run('evaluate_rnn', evaluate_sessions, model, candidates, rows=len(candidates))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic MIND data")
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--articles', type=int)
+    parser.add_argument('--sessions', type=int)
+    parser.add_argument('--history-mean', type=float, default=30)
+    parser.add_argument('--duplicate-rate', type=float, default=0.03)
+    parser.add_argument('--impressions-max', type=int, default=40)
+    parser.add_argument('--near-duplicate-threshold', type=float, default=0.8,
+                        help="Jaccard threshold of the near duplicate detection (0: identical titles only)")
+    parser.add_argument('--min-history', type=int, default=5)
+    parser.add_argument('--chunksize', type=int, default=100_000)
+    parser.add_argument('--n-hist-articles', type=int, default=5)
+    parser.add_argument('--npratio', type=int, default=4)
+    parser.add_argument('--num-negatives', type=int, default=99)
+    parser.add_argument('--test-sessions', type=int, default=10_000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=420)
+    parser.add_argument('--quiet', action='store_true', help="no progress output")
+    parser.add_argument('--profile', nargs='*', default=[],
+                        help="stages to run under cProfile ('all' for every stage)")
+    parser.add_argument('--data-dir', default=None,
+                        help="where the synthetic data is generated (reused if it exists)")
+    parser.add_argument('--output', default=os.path.join(ROOT, 'benchmarks', 'results.json'))
+    args = parser.parse_args()
+
+    config = dict(SCALES[args.scale])
+    for name in ('users', 'articles', 'sessions'):
+        if getattr(args, name) is not None:
+            config[name] = getattr(args, name)
+    config.update(history_mean=args.history_mean, duplicate_rate=args.duplicate_rate,
+                  impressions_max=args.impressions_max, seed=args.seed)
+
+    name = '_'.join(f"{config[k]}" for k in ('users', 'articles', 'sessions'))
+    data_dir = args.data_dir or os.path.join(ROOT, 'data', 'synthetic', name)
+
+    configure(verbose=not args.quiet, profile_dir=os.path.join(ROOT, 'benchmarks', 'profiles'),
+              profile_stages='all' if args.profile == ['all'] else args.profile)
+    bench = Benchmark()
+    if not os.path.exists(os.path.join(data_dir, 'behaviors.tsv')):
+        bench.run('generate', write_dataset, data_dir, n_users=config['users'],
+                  n_articles=config['articles'], n_sessions=config['sessions'],
+                  duplicate_rate=config['duplicate_rate'], random_seed=config['seed'],
+                  history_mean=config['history_mean'], impressions_max=config['impressions_max'],
+                  rows=config['sessions'])
+    run_pipeline(data_dir, args, bench)
+
+    result = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'commit': git_commit(),
+              'dataset': config,
+              'params': {k: v for k, v in vars(args).items()
+                         if k not in config and k not in ('output', 'quiet', 'profile')},
+              'platform': {'python': platform.python_version(), 'machine': platform.machine(),
+                           'cpus': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__},
+              'stages': bench.stages,
+              'total_wall_s': sum(s['wall_s'] for s in bench.stages if s['stage'] != 'generate')}
+
+    results = []
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            results = json.load(f)
+    results.append(result)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Generator for synthetic, MIND-shaped news.tsv and behaviors.tsv files, so
+# that the pipeline can be benchmarked without the real MIND data.
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+CATEGORIES = ['news', 'sports', 'finance', 'lifestyle', 'health', 'travel',
+              'foodanddrink', 'weather', 'autos', 'video', 'music', 'tv']
+
+
+def generate_news(n_articles, duplicate_rate=0.03, entities_per_article=2, rng=None):
+    # articles N1 ... Nn; a fraction `duplicate_rate` of them repeats the
+    # title of an earlier article (republications with a new ID)
+    rng = rng or np.random.default_rng()
+    ids = np.char.add('N', np.arange(1, n_articles + 1).astype(str))
+
+    title_ids = np.arange(n_articles)
+    duplicates = np.flatnonzero(rng.random(n_articles) < duplicate_rate)
+    duplicates = duplicates[duplicates > 0]
+    title_ids[duplicates] = rng.integers(0, duplicates)
+
+    categories = rng.integers(len(CATEGORIES), size=n_articles)
+    entity_ids = rng.integers(1, 10 * n_articles, size=(n_articles, entities_per_article))
+    entities = ['[' + ', '.join(f'{{"Label": "e{q}", "Type": "P", "WikidataId": "Q{q}", '
+                                f'"Confidence": 1.0, "OccurrenceOffsets": [0], "SurfaceForms": ["e{q}"]}}'
+                                for q in row) + ']' for row in entity_ids]
+
+    return pd.DataFrame({'article_id': ids,
+                         'category': np.array(CATEGORIES)[categories],
+                         'subcategory': np.char.add('sub', (categories * 10 + rng.integers(10, size=n_articles)).astype(str)),
+                         'title': np.char.add('title of story ', title_ids.astype(str)),
+                         'abstract': np.char.add('abstract words about story ', title_ids.astype(str)),
+                         'url': np.char.add('https://assets.msn.com/labs/mind/', np.char.add(ids, '.html')),
+                         'title_entities': entities,
+                         'abstract_entities': '[]'})
+
+
+def generate_behaviors(n_sessions, n_users, n_articles, history_mean=30, history_sigma=0.8,
+                       impressions_min=2, impressions_max=40, clicks_max=3,
+                       empty_history_rate=0.05, unknown_rate=0.001, popularity_alpha=1.1,
+                       start='2019-11-09', days=6, rng=None):
+    # sessions of users with lognormally distributed history lengths and
+    # article popularity following a zipf-like law. A fraction of histories
+    # is empty and a few articles are unknown to the news file, as in MIND.
+    rng = rng or np.random.default_rng()
+    popularity = 1 / np.arange(1, n_articles + 1) ** popularity_alpha
+    cdf = np.cumsum(rng.permutation(popularity))
+    cdf /= cdf[-1]
+
+    def draw_articles(size):
+        articles = np.searchsorted(cdf, rng.random(size)) + 1
+        unknown = rng.random(size) < unknown_rate
+        articles[unknown] = n_articles + 1 + rng.integers(1000, size=unknown.sum())
+        return np.char.add('N', articles.astype(str))
+
+    def join(tokens, lengths):
+        ends = np.cumsum(lengths)
+        return [' '.join(tokens[end - n:end]) for n, end in zip(lengths, ends)]
+
+    users = rng.integers(n_users, size=n_sessions)
+    # every user has the same history in all of its sessions
+    user_hist_len = np.maximum(rng.lognormal(np.log(history_mean), history_sigma, n_users).astype(int), 1)
+    user_hist_len[rng.random(n_users) < empty_history_rate] = 0
+    user_histories = np.array(join(draw_articles(user_hist_len.sum()), user_hist_len), dtype=object)
+    user_histories[user_hist_len == 0] = np.nan
+
+    impr_len = rng.integers(impressions_min, impressions_max + 1, size=n_sessions)
+    impr_articles = draw_articles(impr_len.sum())
+    clicks = np.zeros(impr_len.sum(), dtype=int)
+    starts = np.cumsum(impr_len) - impr_len
+    n_clicks = np.minimum(rng.integers(1, clicks_max + 1, size=n_sessions), impr_len)
+    click_pos = starts.repeat(n_clicks) + (rng.random(n_clicks.sum()) * n_clicks.repeat(n_clicks)).astype(int)
+    clicks[click_pos] = 1
+    impressions = join(np.char.add(np.char.add(impr_articles, '-'), clicks.astype(str)), impr_len)
+
+    seconds = np.sort(rng.integers(days * 24 * 3600, size=n_sessions))
+    times = (pd.Timestamp(start) + pd.to_timedelta(seconds, unit='s')).strftime('%-m/%-d/%Y %-I:%M:%S %p')
+
+    return pd.DataFrame({'impression_id': np.arange(1, n_sessions + 1),
+                         'user_id': np.char.add('U', users.astype(str)),
+                         'time': times,
+                         'history': user_histories[users],
+                         'impressions': impressions})
+
+
+def write_dataset(output_dir, n_users=10_000, n_articles=5_000, n_sessions=50_000,
+                  duplicate_rate=0.03, random_seed=420, **behaviors_kwargs):
+    rng = np.random.default_rng(random_seed)
+    os.makedirs(output_dir, exist_ok=True)
+
+    news = generate_news(n_articles, duplicate_rate=duplicate_rate, rng=rng)
+    news.to_csv(os.path.join(output_dir, 'news.tsv'), sep='\t', header=False, index=False)
+
+    behaviors = generate_behaviors(n_sessions, n_users, n_articles, rng=rng, **behaviors_kwargs)
+    behaviors.to_csv(os.path.join(output_dir, 'behaviors.tsv'), sep='\t', header=False, index=False)
+
+    return output_dir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__ or "Generate a synthetic MIND-shaped dataset")
+    parser.add_argument('output_dir')
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--articles', type=int, default=5_000)
+    parser.add_argument('--sessions', type=int, default=50_000)
+    parser.add_argument('--history-mean', type=float, default=30)
+    parser.add_argument('--duplicate-rate', type=float, default=0.03)
+    parser.add_argument('--impressions-max', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=420)
+    args = parser.parse_args()
+
+    write_dataset(args.output_dir, n_users=args.users, n_articles=args.articles,
+                  n_sessions=args.sessions, duplicate_rate=args.duplicate_rate,
+                  random_seed=args.seed, history_mean=args.history_mean,
+                  impressions_max=args.impressions_max)
@@ -1,6 +1,11 @@
-import random
+import math
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+# progress output of the helpers below. Scripts can replace it, e.g. with
+# profilingHelper.log to silence it together with the preprocessing output.
+log = print
 
 def import_behaviors(path_to_file):    
         fn = path_to_file.split("/")[-1]
@@ -21,11 +26,16 @@ def dataframe_to_numpy(dataframe, return_columndict=True):
     
     return df_array
 
-def encode_articles(dataframe):
+def encode_articles(dataframe, article2idx=None):
+    # article codes are assigned in order of first appearance, so they are the
+    # same in every run. An existing `article2idx` is only extended (new
+    # articles get the next free codes), e.g. when a new day of data comes in.
+    known = dict(article2idx or {})
+    article2idx = dict(known)
 
     df_array, columndict = dataframe_to_numpy(dataframe)
     
-    print("Creating list of all articles in behaviors...")
+    log("Creating list of all articles in behaviors...")
     articles = []
     for row in df_array:
         for article in row[columndict['history_split']]:
@@ -33,12 +43,15 @@ def encode_articles(dataframe):
         for article in row[columndict['impressions_split']]:
             articles.append(article[:-2]) 
     
-    print("Creating unique articles set")
-    unique_articles = set(articles)
+    log("Creating unique articles set")
+    for article in dict.fromkeys(articles):
+        article2idx.setdefault(article, len(article2idx))
+    assert all(article2idx[article] == idx for article, idx in known.items()), \
+        "extending article2idx changed the codes of known articles"
+    unique_articles = set(article2idx)
     num_articles = len(unique_articles)
-    article2idx = {u:i for i, u in enumerate(unique_articles)}
     
-    print("Encoding articles in dataframe with integers...")
+    log("Encoding articles in dataframe with integers...")
     dataframe['history_int'] = dataframe.history_split.apply(lambda x: [article2idx[i] for i in x])
     
     dataframe['impressions_int_1'] = dataframe.impressions_split.apply(lambda x: [article2idx[art[:-2]] for art in x if art[-1] == '1'])
@@ -47,104 +60,273 @@ def encode_articles(dataframe):
     
     return dataframe, unique_articles, num_articles, article2idx
 
-def create_pos_neg(dataframe, n_hist_articles=5, npratio=1):
-    
-    impressions_1 = dataframe["impressions_int_1"].to_numpy()
-    impressions_0 = dataframe["impressions_int_0"].to_numpy()
-    articles_as_int = dataframe['history_int'].to_numpy()
+def flatten_lists(column):
+    # CSR-style representation (indptr, flat) of a column of integer lists
+    lengths = np.fromiter((len(l) for l in column), dtype=np.int64, count=len(column))
+    indptr = np.concatenate(([0], np.cumsum(lengths)))
+    flat = np.fromiter((x for l in column for x in l), dtype=np.int32, count=indptr[-1])
+
+    return indptr, flat
+
+
+def create_pos_neg(dataframe, n_hist_articles=5, npratio=1, random_seed=None):
+    # returns one int32 array with a 'positive' trajectory per session (last
+    # n_hist_articles of the history + a clicked article) and one with
+    # `npratio` 'negative' trajectories per session (+ a not clicked
+    # article). The negatives of session i are rows i*npratio ... (i+1)*npratio-1.
+    rng = np.random.default_rng(random_seed)
+
+    hist_indptr, hist_flat = flatten_lists(dataframe['history_int'].to_numpy())
+    pos_indptr, pos_flat = flatten_lists(dataframe['impressions_int_1'].to_numpy())
+    neg_indptr, neg_flat = flatten_lists(dataframe['impressions_int_0'].to_numpy())
+    n = len(hist_indptr) - 1
+    len_trajectory = n_hist_articles + 1
+
+    assert (np.diff(hist_indptr) >= n_hist_articles).all(), f"histories shorter than {n_hist_articles} articles"
+    assert (np.diff(pos_indptr) > 0).all() and (np.diff(neg_indptr) > 0).all(), "sessions without clicked or not clicked articles"
+
+    log("Create array of 'positive' trajectories...")
+    window = hist_indptr[1:, None] - np.arange(n_hist_articles, 0, -1)
+    history_windows = hist_flat[window]
+
+    complete_list_1s = np.empty((n, len_trajectory), dtype=np.int32)
+    complete_list_1s[:, :-1] = history_windows
+    complete_list_1s[:, -1] = pos_flat[pos_indptr[:-1]]
+
+    log("Create array of 'negative' trajectories...")
+    # sampling without replacement within every session: if there are fewer
+    # not clicked articles than npratio, they are repeated npratio//len+1 times
+    neg_lengths = np.diff(neg_indptr)
+    repeats = np.where(npratio > neg_lengths, npratio // neg_lengths + 1, 1)
+    element_repeats = np.repeat(repeats, neg_lengths)
+    candidates = np.repeat(neg_flat, element_repeats)
+    rows = np.repeat(np.arange(n), neg_lengths * repeats)
+
+    order = np.lexsort((rng.random(len(candidates)), rows))
+    row_starts = np.concatenate(([0], np.cumsum(neg_lengths * repeats)[:-1]))
+    picks = order[(row_starts[:, None] + np.arange(npratio)).ravel()]
+
+    complete_list_0s = np.empty((n * npratio, len_trajectory), dtype=np.int32)
+    complete_list_0s[:, :-1] = np.repeat(history_windows, npratio, axis=0)
+    complete_list_0s[:, -1] = candidates[picks]
 
-    assert len(articles_as_int) == len(impressions_0) == len(impressions_1), "something wrong!"
-    
-    print("Create complete list of 'positive' articles...")
-    complete_list_1s = []
-    for i, hist in enumerate(articles_as_int):
-        list_1s = []
-        for art_int in hist[-n_hist_articles:]:
-            list_1s.append(art_int)
-        list_1s.append(impressions_1[i][0])
-        complete_list_1s.append(list_1s)
-    
-    assert len(complete_list_1s) == len(articles_as_int), "oh no!"
-   
-    print("Create complete list of 'negative' articles...")
-    complete_list_0s = []
-    for i, hist in enumerate(articles_as_int):
-        list_0s = []
-        for art_int in hist[-n_hist_articles:]:
-            list_0s.append(art_int)
-        
-        negs = impressions_0[i]
-        if npratio > len(negs):
-            neg = random.sample(negs*(npratio//len(negs)+1), npratio)
-        else:
-            neg = random.sample(negs, npratio)
-        
-        for n in neg:
-            complete_list_0s.append(list_0s + [n])
-    
     assert len(complete_list_1s) == len(complete_list_0s) / npratio, "almost did it, but still something wrong"
-    
+
     return complete_list_1s, complete_list_0s
 
+
 def rnn_train_val_split(complete_list_1s, complete_list_0s, train_ratio=0.8, val_ratio=0.2, random_seed=420):
     
     assert train_ratio + val_ratio == 1, f"incosistent train and val ratios ({train_ratio}, {val_ratio})"
     
-    number_of_indexes = len(complete_list_1s)
+    number_of_indexes, len_trajectory = complete_list_1s.shape
     npratio = len(complete_list_0s)//len(complete_list_1s)
+    negatives = complete_list_0s.reshape(number_of_indexes, npratio, len_trajectory)
     
-    random.seed(random_seed)
-    train_indexes = random.sample(range(number_of_indexes), int(train_ratio*number_of_indexes))
-    test_indexes = list(set(range(number_of_indexes)) - set(train_indexes))
-    
-    complete_list_1s_train = [complete_list_1s[i] for i in train_indexes]
-    complete_list_1s_test = [complete_list_1s[i] for i in test_indexes]
-    
-    complete_list_0s_train = []
-    for i in train_indexes:
-        for t in range(npratio):
-            train_list = complete_list_0s[i*npratio + t]
-            complete_list_0s_train.append(train_list)
-    
-    assert len(complete_list_1s_train) == len(complete_list_0s_train) / npratio, "something wrong with the inputs"
-    
-    complete_list_0s_test = []
-    for i in test_indexes:
-        for t in range(npratio):
-            test_list = complete_list_0s[i*npratio + t]
-            complete_list_0s_test.append(test_list)
+    rng = np.random.default_rng(random_seed)
+    permutation = rng.permutation(number_of_indexes)
+    train_indexes = permutation[:int(train_ratio*number_of_indexes)]
+    test_indexes = np.sort(permutation[int(train_ratio*number_of_indexes):])
     
-    assert len(complete_list_1s_test) == len(complete_list_0s_test) / npratio, "something wrong with the inputs"
+    # every positive trajectory is followed by its npratio negative trajectories
+    def interleave(indexes):
+        array = np.empty((len(indexes), npratio + 1, len_trajectory), dtype=np.int32)
+        array[:, 0] = complete_list_1s[indexes]
+        array[:, 1:] = negatives[indexes]
+        targets = np.zeros((len(indexes), npratio + 1), dtype=np.int32)
+        targets[:, 0] = 1
+        return array.reshape(-1, len_trajectory), targets.ravel()
     
-    train = []
-    train_targets = []
-    for i, l in enumerate(complete_list_1s_train):
-        train.append(l)
-        train_targets.append(1)
-        for j in range(npratio):
-            train.append(complete_list_0s_train[i*npratio + j])
-            train_targets.append(0)
-    
-    valid = []
-    valid_targets = []
-    for i, l in enumerate(complete_list_1s_test):
-        valid.append(l)
-        valid_targets.append(1)
-        for j in range(npratio):
-            valid.append(complete_list_0s_test[i*npratio + j])
-            valid_targets.append(0)
-    
-    assert len(train_targets) == len(train)
-    assert len(valid_targets) == len(valid)
-
-    train_array = np.array(train)
-    valid_array = np.array(valid)
-    train_targets_array = np.array(train_targets)
-    valid_targets_array = np.array(valid_targets)
-    
-    train_array = train_array.reshape(len(train), 6)
-    valid_array = valid_array.reshape(len(valid), 6)
+    train_array, train_targets_array = interleave(train_indexes)
+    valid_array, valid_targets_array = interleave(test_indexes)
 
     return (train_array, valid_array, 
             train_targets_array, valid_targets_array,
-            train_indexes, test_indexes)
\ No newline at end of file
+            train_indexes, test_indexes)
+
+
+def _sample_test_shard(indptr, flat, num_articles, num_test_negs, seed, max_rounds=100):
+    # negatives for one shard of test sessions, whose histories are given
+    # CSR-style (indptr, flat): `num_test_negs` articles per session, which
+    # are not in the (complete) history of the session. Collisions are drawn
+    # again for at most `max_rounds` rounds, as in sample_negatives.
+    rng = np.random.default_rng(seed)
+    n = len(indptr) - 1
+    lengths = np.diff(indptr)
+
+    # (session, article) pairs of all histories as sorted int64 keys
+    rows = np.arange(n)
+    hist_keys = np.unique(np.repeat(rows, lengths) * num_articles + flat)
+
+    def in_history(r, articles):
+        keys = r * num_articles + articles
+        pos = np.minimum(np.searchsorted(hist_keys, keys), max(len(hist_keys) - 1, 0))
+        return hist_keys[pos] == keys if len(hist_keys) else np.zeros(keys.shape, dtype=bool)
+
+    negatives = rng.integers(num_articles, size=(n, num_test_negs))
+    collisions = in_history(rows[:, None], negatives)
+    for _ in range(max_rounds):
+        if not collisions.any():
+            break
+        r, c = np.nonzero(collisions)
+        negatives[r, c] = rng.integers(num_articles, size=len(r))
+        collisions[r, c] = in_history(r, negatives[r, c])
+    if collisions.any():
+        raise ValueError(f"could not sample test negatives within {max_rounds} rounds, "
+                         "some histories contain (almost) all articles")
+
+    return negatives.astype(np.int32)
+
+
+def create_test_candidates(histories, positives, num_articles, n_hist_articles=5,
+                           num_test_negs=99, random_seed=420, workers=1, shard_size=5000,
+                           max_rounds=100):
+    # test protocol of the RNN models: for every session the positive
+    # trajectory (last n_hist_articles + clicked article) is ranked against
+    # `num_test_negs` trajectories ending on random unread articles.
+    # The sessions are split into shards of `shard_size`, which are
+    # processed by a pool of `workers` processes. Every shard gets its own
+    # seed, so the result does not depend on the number of workers.
+    # Returns an int32 array of shape (sessions, num_test_negs+1, n_hist_articles+1).
+    positives = np.asarray(positives, dtype=np.int32)
+    lengths = np.array([len(hist) for hist in histories], dtype=np.int64)
+    assert len(lengths) == len(positives), "histories and positives don't match"
+    assert (lengths >= n_hist_articles).all(), f"histories shorter than {n_hist_articles} articles"
+    indptr = np.concatenate(([0], np.cumsum(lengths)))
+    flat = np.fromiter((art for hist in histories for art in hist),
+                       dtype=np.int64, count=indptr[-1])
+
+    starts = list(range(0, len(positives), shard_size)) or [0]
+    seeds = np.random.SeedSequence(random_seed).spawn(len(starts))
+    shards = []
+    for i, seed in zip(starts, seeds):
+        shard_indptr = indptr[i:i+shard_size+1]
+        shards.append((shard_indptr - shard_indptr[0], flat[shard_indptr[0]:shard_indptr[-1]],
+                       num_articles, num_test_negs, seed, max_rounds))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            negatives = list(pool.map(_sample_test_shard, *zip(*shards)))
+    else:
+        negatives = [_sample_test_shard(*shard) for shard in shards]
+
+    window = indptr[1:, None] - np.arange(n_hist_articles, 0, -1)
+    candidates = np.empty((len(positives), num_test_negs + 1, n_hist_articles + 1), dtype=np.int32)
+    candidates[:, :, :-1] = flat[window][:, None, :]
+    candidates[:, 0, -1] = positives
+    candidates[:, 1:, -1] = np.concatenate(negatives)
+
+    return candidates
+
+
+def evaluate_sessions(model, candidates, K=10, batch_size=10_000):
+    # ranks the positive (first) candidate of every session against its
+    # negatives. All trajectories are scored with large predict batches and
+    # the rank is the number of negatives with a strictly higher score.
+    n_sessions, n_candidates, len_trajectory = candidates.shape
+    predictions = model.predict(candidates.reshape(-1, len_trajectory),
+                                batch_size=batch_size, verbose=0)
+    scores = np.asarray(predictions).reshape(n_sessions, n_candidates)
+
+    ranks = (scores[:, 1:] > scores[:, :1]).sum(axis=1)
+    hits = (ranks < K).astype(np.float64)
+    ndcgs = np.where(ranks < K, math.log(2) / np.log(ranks + 2), 0)
+    rrs = np.where(ranks < K, 1 / (ranks + 1), 0)
+
+    return hits, ndcgs, rrs
+
+
+def session_arrays(dataframe):
+    # integer encoded histories and impressions of an encoded behaviors
+    # dataframe (see encode_articles) in the CSR layout, which
+    # data_preprocessing.py writes to behaviors_processed_arrays/
+    history_indptr, history_indices = flatten_lists(dataframe['history_int'].to_numpy())
+    impressions = [pos + neg for pos, neg in zip(dataframe['impressions_int_1'],
+                                                 dataframe['impressions_int_0'])]
+    impressions_indptr, impressions_indices = flatten_lists(impressions)
+    labels = [[1]*len(pos) + [0]*len(neg) for pos, neg in zip(dataframe['impressions_int_1'],
+                                                              dataframe['impressions_int_0'])]
+    _, impressions_labels = flatten_lists(labels)
+
+    return {'history_indptr': history_indptr,
+            'history_indices': history_indices,
+            'impressions_indptr': impressions_indptr,
+            'impressions_indices': impressions_indices,
+            'impressions_labels': impressions_labels.astype(np.int8)}
+
+
+def split_impressions(arrays):
+    # clicked and not clicked impressions as two separate CSR structures
+    indptr = np.asarray(arrays['impressions_indptr'])
+    indices = np.asarray(arrays['impressions_indices'])
+    labels = np.asarray(arrays['impressions_labels'])
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+    split = {}
+    for name, mask in (('clicked', labels == 1), ('not_clicked', labels == 0)):
+        counts = np.bincount(rows[mask], minlength=len(indptr) - 1)
+        split[name] = (np.concatenate(([0], np.cumsum(counts))), indices[mask])
+
+    return split
+
+
+def rnn_batch_generator(arrays, n_hist_articles=5, npratio=1, batch_size=256,
+                        indexes=None, random_seed=None):
+    # streams shuffled (trajectories, targets) batches, instead of
+    # materializing all trajectories up front. Every session contributes its
+    # positive trajectory and `npratio` negative trajectories, whose articles
+    # are freshly drawn (with replacement) from the not clicked impressions
+    # of the session whenever the returned generator function is called, i.e.
+    # every epoch. `batch_size` is the number of sessions per batch. Returns
+    # the generator function and the number of batches per epoch.
+    rng = np.random.default_rng(random_seed)
+    history_indptr = np.asarray(arrays['history_indptr'])
+    history_indices = np.asarray(arrays['history_indices'])
+    split = split_impressions(arrays)
+    pos_indptr, pos_flat = split['clicked']
+    neg_indptr, neg_flat = split['not_clicked']
+
+    n_sessions = len(history_indptr) - 1
+    indexes = np.arange(n_sessions) if indexes is None else np.asarray(indexes)
+    usable = (np.diff(history_indptr)[indexes] >= n_hist_articles) \
+        & (np.diff(pos_indptr)[indexes] > 0) & (np.diff(neg_indptr)[indexes] > 0)
+    indexes = indexes[usable]
+
+    len_trajectory = n_hist_articles + 1
+    targets = np.zeros((batch_size, npratio + 1), dtype=np.int32)
+    targets[:, 0] = 1
+
+    def generator():
+        order = rng.permutation(indexes)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start+batch_size]
+            n = len(batch)
+
+            window = history_indptr[batch + 1, None] - np.arange(n_hist_articles, 0, -1)
+            trajectories = np.empty((n, npratio + 1, len_trajectory), dtype=np.int32)
+            trajectories[:, :, :-1] = history_indices[window][:, None, :]
+            trajectories[:, 0, -1] = pos_flat[pos_indptr[batch]]
+
+            neg_lengths = neg_indptr[batch + 1] - neg_indptr[batch]
+            picks = (rng.random((n, npratio)) * neg_lengths[:, None]).astype(np.int64)
+            trajectories[:, 1:, -1] = neg_flat[neg_indptr[batch, None] + picks]
+
+            yield trajectories.reshape(-1, len_trajectory), targets[:n].ravel()
+
+    return generator, math.ceil(len(indexes) / batch_size)
+
+
+def rnn_dataset(arrays, n_hist_articles=5, npratio=1, batch_size=256,
+                indexes=None, random_seed=None):
+    # tf.data wrapper around rnn_batch_generator: the generator is called
+    # again for every epoch and batches are prefetched in the background
+    import tensorflow as tf
+
+    generator, steps_per_epoch = rnn_batch_generator(arrays, n_hist_articles=n_hist_articles,
+                                                     npratio=npratio, batch_size=batch_size,
+                                                     indexes=indexes, random_seed=random_seed)
+    signature = (tf.TensorSpec(shape=(None, n_hist_articles + 1), dtype=tf.int32),
+                 tf.TensorSpec(shape=(None,), dtype=tf.int32))
+    dataset = tf.data.Dataset.from_generator(generator, output_signature=signature)
+
+    return dataset.prefetch(tf.data.AUTOTUNE), steps_per_epoch
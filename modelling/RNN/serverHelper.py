@@ -0,0 +1,408 @@
+import json
+import time
+import socket
+import asyncio
+import argparse
+from collections import OrderedDict, deque, Counter
+import numpy as np
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+ACTIVATIONS = {'linear': lambda x: x,
+               'sigmoid': sigmoid,
+               'hard_sigmoid': lambda x: np.clip(0.2 * x + 0.5, 0, 1),
+               'tanh': np.tanh,
+               'relu': lambda x: np.maximum(x, 0)}
+
+
+# ## Recurrent models in numpy
+# The LSTM/GRU models of RNN.ipynb (Embedding -> LSTM/GRU -> Dense layers)
+# score a trajectory of n_hist_articles read articles plus one candidate, and
+# the candidate is only the last step of the recurrence. So the recurrent
+# state after the history can be computed once and reused for every
+# candidate. The weights are exported from keras into numpy arrays, which
+# also avoids the overhead of model.predict for small batches.
+
+class RecurrentScorer:
+
+    def __init__(self, kind, embedding, kernel, recurrent_kernel, bias, dense,
+                 activation='tanh', recurrent_activation='sigmoid', reset_after=True):
+        assert kind in ('lstm', 'gru'), f"unknown recurrent layer {kind}"
+        self.kind = kind
+        self.embedding = np.asarray(embedding, dtype=np.float32)
+        self.kernel = np.asarray(kernel, dtype=np.float32)
+        self.recurrent_kernel = np.asarray(recurrent_kernel, dtype=np.float32)
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.dense = [(np.asarray(w, dtype=np.float32), np.asarray(b, dtype=np.float32), act)
+                      for w, b, act in dense]
+        self.activation = activation
+        self.recurrent_activation = recurrent_activation
+        self.reset_after = reset_after
+        self.units = self.recurrent_kernel.shape[0]
+
+    @classmethod
+    def from_keras(cls, model):
+        # copies the weights of a trained Sequential model as in RNN.ipynb.
+        # Layers without weights in the head (e.g. Dropout) are skipped.
+        embedding, recurrent, *head = model.layers
+        config = recurrent.get_config()
+        kernel, recurrent_kernel, bias = recurrent.get_weights()
+        dense = [(*layer.get_weights(), layer.get_config().get('activation', 'linear'))
+                 for layer in head if layer.get_weights()]
+
+        return cls(type(recurrent).__name__.lower(), embedding.get_weights()[0],
+                   kernel, recurrent_kernel, bias, dense,
+                   activation=config.get('activation', 'tanh'),
+                   recurrent_activation=config.get('recurrent_activation', 'sigmoid'),
+                   reset_after=config.get('reset_after', True))
+
+    def save(self, path_to_file):
+        arrays = {'embedding': self.embedding, 'kernel': self.kernel,
+                  'recurrent_kernel': self.recurrent_kernel, 'bias': self.bias}
+        for i, (w, b, _) in enumerate(self.dense):
+            arrays[f'dense_{i}_kernel'], arrays[f'dense_{i}_bias'] = w, b
+        config = {'kind': self.kind, 'activation': self.activation,
+                  'recurrent_activation': self.recurrent_activation,
+                  'reset_after': self.reset_after,
+                  'dense_activations': [act for _, _, act in self.dense]}
+        np.savez(path_to_file, config=json.dumps(config), **arrays)
+
+    @classmethod
+    def load(cls, path_to_file):
+        f = np.load(path_to_file)
+        config = json.loads(str(f['config']))
+        dense = [(f[f'dense_{i}_kernel'], f[f'dense_{i}_bias'], act)
+                 for i, act in enumerate(config['dense_activations'])]
+
+        return cls(config['kind'], f['embedding'], f['kernel'], f['recurrent_kernel'], f['bias'],
+                   dense, activation=config['activation'],
+                   recurrent_activation=config['recurrent_activation'],
+                   reset_after=config['reset_after'])
+
+    def initial_state(self, n):
+        zeros = np.zeros((n, self.units), dtype=np.float32)
+        return (zeros, zeros) if self.kind == 'lstm' else (zeros,)
+
+    def cell(self, articles, state):
+        # one recurrent step for a batch of articles, same equations as keras
+        x = self.embedding[articles]
+        act = ACTIVATIONS[self.activation]
+        rec_act = ACTIVATIONS[self.recurrent_activation]
+        u = self.units
+
+        if self.kind == 'lstm':
+            h, c = state
+            z = x @ self.kernel + h @ self.recurrent_kernel + self.bias
+            i, f, g, o = rec_act(z[:, :u]), rec_act(z[:, u:2*u]), act(z[:, 2*u:3*u]), rec_act(z[:, 3*u:])
+            c = f * c + i * g
+            return (o * act(c), c)
+
+        h, = state
+        if self.reset_after:
+            x_part = x @ self.kernel + self.bias[0]
+            h_part = h @ self.recurrent_kernel + self.bias[1]
+            zr = rec_act(x_part[:, :2*u] + h_part[:, :2*u])
+            r_h = h_part[:, 2*u:]
+        else:
+            x_part = x @ self.kernel + self.bias
+            zr = rec_act(x_part[:, :2*u] + h @ self.recurrent_kernel[:, :2*u])
+            r_h = None
+        z, r = zr[:, :u], zr[:, u:]
+        if r_h is None:
+            candidate = act(x_part[:, 2*u:] + (r * h) @ self.recurrent_kernel[:, 2*u:])
+        else:
+            candidate = act(x_part[:, 2*u:] + r * r_h)
+        return (z * h + (1 - z) * candidate,)
+
+    def encode(self, histories):
+        # recurrent state after the articles of every history (one per row)
+        histories = np.asarray(histories)
+        state = self.initial_state(len(histories))
+        for t in range(histories.shape[1]):
+            state = self.cell(histories[:, t], state)
+
+        return state
+
+    def score(self, candidates, state):
+        # scores of candidate articles continuing the given histories' states
+        h = self.cell(np.asarray(candidates), state)[0]
+        for w, b, act in self.dense:
+            h = ACTIVATIONS[act](h @ w + b)
+
+        return h[:, 0]
+
+    def predict(self, trajectories, batch_size=10_000, verbose=0):
+        # same interface as the keras model, so it can be used in evaluate_sessions
+        trajectories = np.asarray(trajectories)
+        scores = np.empty(len(trajectories), dtype=np.float32)
+        for start in range(0, len(trajectories), batch_size):
+            batch = trajectories[start:start+batch_size]
+            scores[start:start+len(batch)] = self.score(batch[:, -1], self.encode(batch[:, :-1]))
+
+        return scores[:, None]
+
+
+# ## Micro-batching
+# Concurrent "rank these candidates for this history" requests are queued and
+# scored together: a batch is closed when it has max_batch_rows candidates or
+# max_wait_ms after its first request. The states of recent histories are
+# kept in an LRU cache, so a history is only run through the RNN once.
+
+class LatencyStats:
+
+    def __init__(self, window=10_000):
+        self.latencies = deque(maxlen=window)
+        self.batch_requests = Counter()
+        self.batch_rows = Counter()
+        self.requests = 0
+        self.batches = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @staticmethod
+    def bucket(n):
+        # power of two histogram buckets: 1, 2, 4, 8, ...
+        return 1 << max(int(n) - 1, 0).bit_length()
+
+    def add_batch(self, n_requests, n_rows):
+        self.batches += 1
+        self.batch_requests[self.bucket(n_requests)] += 1
+        self.batch_rows[self.bucket(n_rows)] += 1
+
+    def report(self):
+        latencies = np.array(self.latencies) * 1000
+        percentiles = {f'p{p}': float(np.percentile(latencies, p)) if len(latencies) else None
+                       for p in (50, 90, 99)}
+        lookups = self.cache_hits + self.cache_misses
+
+        return {'requests': self.requests,
+                'batches': self.batches,
+                'latency_ms': percentiles,
+                'mean_requests_per_batch': self.requests / self.batches if self.batches else None,
+                'batch_requests_histogram': dict(sorted(self.batch_requests.items())),
+                'batch_rows_histogram': dict(sorted(self.batch_rows.items())),
+                'cache_hit_rate': self.cache_hits / lookups if lookups else None}
+
+
+class MicroBatcher:
+
+    def __init__(self, scorer, n_hist_articles=5, max_batch_rows=4096, max_wait_ms=2.0,
+                 cache_size=100_000):
+        self.scorer = scorer
+        self.n_hist_articles = n_hist_articles
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.stats = LatencyStats()
+        self.queue = None
+
+    async def rank(self, history, candidates):
+        # scores of the candidates after the last n_hist_articles of the history.
+        # Requests are checked before they are queued (with exceptions, which
+        # unlike asserts also run under python -O): a bad request would
+        # otherwise fail the whole batch it is scored in.
+        history, candidates = np.asarray(history), np.asarray(candidates)
+        if history.ndim != 1 or len(history) < self.n_hist_articles:
+            raise ValueError(f"histories need {self.n_hist_articles} articles")
+        if candidates.ndim != 1:
+            raise ValueError("candidates must be a list of article ids")
+        n_articles = len(self.scorer.embedding)
+        for name, ids in (('history', history), ('candidates', candidates)):
+            if ids.size and ids.dtype.kind not in 'iu':
+                raise TypeError(f"{name} must be integer article ids")
+            if not ((ids >= 0) & (ids < n_articles)).all():
+                raise ValueError(f"{name} contains article ids outside of 0..{n_articles - 1}")
+
+        if self.queue is None:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((tuple(history[-self.n_hist_articles:].tolist()), candidates.astype(np.int64),
+                              time.perf_counter(), future))
+        return await future
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            rows = len(batch[0][1])
+            deadline = loop.time() + self.max_wait
+            while rows < self.max_batch_rows:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(request)
+                rows += len(request[1])
+
+            # numpy releases the GIL, so the event loop keeps accepting
+            # requests while the batch is scored in a thread
+            try:
+                scores = await loop.run_in_executor(None, self.score_batch, batch)
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            now = time.perf_counter()
+            self.stats.add_batch(len(batch), rows)
+            for (_, _, start, future), request_scores in zip(batch, scores):
+                self.stats.requests += 1
+                self.stats.latencies.append(now - start)
+                if not future.done():
+                    future.set_result(request_scores)
+
+    def states(self, histories):
+        # recurrent states of the (unique) histories, from the cache if possible
+        missing = [h for h in histories if h not in self.cache]
+        self.stats.cache_hits += len(histories) - len(missing)
+        self.stats.cache_misses += len(missing)
+        if missing:
+            encoded = self.scorer.encode(np.array(missing))
+            for i, h in enumerate(missing):
+                self.cache[h] = tuple(s[i].copy() for s in encoded)
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        states = []
+        for h in histories:
+            self.cache.move_to_end(h)
+            states.append(self.cache[h])
+
+        return tuple(np.stack(s) for s in zip(*states))
+
+    def score_batch(self, batch):
+        # all candidates of the batch in one step: every candidate row gets the
+        # state of its request's history
+        histories = list(dict.fromkeys(h for h, *_ in batch))
+        states = self.states(histories)
+        history_rows = {h: i for i, h in enumerate(histories)}
+
+        lengths = [len(c) for _, c, *_ in batch]
+        rows = np.repeat([history_rows[h] for h, *_ in batch], lengths)
+        candidates = np.concatenate([c for _, c, *_ in batch])
+        scores = self.scorer.score(candidates, tuple(s[rows] for s in states))
+
+        return np.split(scores, np.cumsum(lengths)[:-1])
+
+
+# ## Server and client
+# Plain TCP with one JSON object per line. Requests are
+#   {"id": 1, "history": [12, 5, 7, 9, 2], "candidates": [3, 8, 100]}
+# and are answered with {"id": 1, "scores": [...], "ranking": [...]}, where
+# ranking are the candidates ordered by score. {"stats": true} returns the
+# latency percentiles and batch size histograms.
+
+async def handle_request(batcher, line):
+    request = None
+    try:
+        request = json.loads(line)
+        if request.get('stats'):
+            return {'id': request.get('id'), 'stats': batcher.stats.report()}
+        candidates = np.asarray(request['candidates'])
+        scores = await batcher.rank(request['history'], candidates)
+        order = np.argsort(-scores, kind='stable')
+        return {'id': request.get('id'), 'scores': scores.tolist(),
+                'ranking': candidates[order].tolist()}
+    except Exception as e:
+        # every request gets an answer, the client waits for it otherwise
+        return {'id': request.get('id') if isinstance(request, dict) else None, 'error': str(e)}
+
+
+async def serve(batcher, host='127.0.0.1', port=8765):
+    async def handle(reader, writer):
+        # every line is handled in its own task, so requests pipelined on one
+        # connection are batched together as well (answers carry the id)
+        async def respond(line):
+            response = await handle_request(batcher, line)
+            writer.write((json.dumps(response) + '\n').encode())
+            await writer.drain()
+
+        tasks = set()
+        while line := await reader.readline():
+            task = asyncio.create_task(respond(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        writer.close()
+
+    batcher.start()
+    server = await asyncio.start_server(handle, host, port)
+    return server
+
+
+class SessionClient:
+    # blocking client for the session server
+
+    def __init__(self, host='127.0.0.1', port=8765):
+        self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile('rwb')
+        self.next_id = 0
+
+    def request(self, payload):
+        self.next_id += 1
+        self.file.write((json.dumps({'id': self.next_id, **payload}) + '\n').encode())
+        self.file.flush()
+        return json.loads(self.file.readline())
+
+    def rank(self, history, candidates):
+        return self.request({'history': list(map(int, history)),
+                             'candidates': list(map(int, candidates))})
+
+    def stats(self):
+        return self.request({'stats': True})['stats']
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+async def rank_many(requests, host='127.0.0.1', port=8765):
+    # sends all (history, candidates) requests at once over one connection
+    # and returns the responses in the order of the requests
+    reader, writer = await asyncio.open_connection(host, port)
+    for i, (history, candidates) in enumerate(requests):
+        writer.write((json.dumps({'id': i, 'history': list(map(int, history)),
+                                  'candidates': list(map(int, candidates))}) + '\n').encode())
+    await writer.drain()
+
+    responses = [None] * len(requests)
+    for _ in requests:
+        response = json.loads(await reader.readline())
+        responses[response['id']] = response
+    writer.close()
+
+    return responses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve an exported LSTM/GRU session model")
+    parser.add_argument('weights', help=".npz file written by RecurrentScorer.save")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--n-hist-articles', type=int, default=5)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    parser.add_argument('--max-batch-rows', type=int, default=4096)
+    args = parser.parse_args()
+
+    async def main():
+        batcher = MicroBatcher(RecurrentScorer.load(args.weights), n_hist_articles=args.n_hist_articles,
+                               max_batch_rows=args.max_batch_rows, max_wait_ms=args.max_wait_ms)
+        server = await serve(batcher, args.host, args.port)
+        print(f"Serving on {args.host}:{args.port}")
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+from rankingHelper import top_k
+
+
+def article_texts(news):
+    # title + abstract + category and subcategory as extra tokens, so that
+    # articles of the same (sub)category are a bit more similar
+    return (news.title.fillna('') + ' ' + news.abstract.fillna('')
+            + ' cat_' + news.category.fillna('').astype(str)
+            + ' subcat_' + news.subcategory.fillna('').astype(str))
+
+
+class ContentIndex:
+    # sparse TF-IDF index over the news articles. Terms are hashed (no
+    # vocabulary to refit) and the IDF weights are fixed when the index is
+    # fitted, so newly published articles can be added with add_articles
+    # without touching the vectors of the existing articles. All article
+    # vectors are L2-normalized, so dot products are cosine similarities.
+
+    def __init__(self, n_features=2**20, stop_words='english'):
+        self.vectorizer = HashingVectorizer(n_features=n_features, stop_words=stop_words,
+                                            alternate_sign=False, norm=None)
+        self.idf = None
+        self.matrix = None
+        self.article_ids = pd.Index([])
+
+    def transform(self, news):
+        tf = self.vectorizer.transform(article_texts(news))
+        return normalize(tf @ sp.diags(self.idf), norm='l2').tocsr().astype(np.float32)
+
+    def fit(self, news):
+        tf = self.vectorizer.transform(article_texts(news))
+        df = np.bincount(tf.indices, minlength=tf.shape[1])
+        # smoothed idf as in sklearn's TfidfTransformer
+        self.idf = np.log((1 + tf.shape[0]) / (1 + df)) + 1
+
+        self.matrix = self.transform(news)
+        self.article_ids = pd.Index(news.article_id)
+
+        return self
+
+    def add_articles(self, news):
+        news = news[~news.article_id.isin(self.article_ids)]
+        self.matrix = sp.vstack([self.matrix, self.transform(news)], format='csr')
+        self.article_ids = self.article_ids.append(pd.Index(news.article_id))
+
+        return self
+
+    def rows(self, article_ids):
+        # row of every article in the index, -1 for unknown articles
+        return self.article_ids.get_indexer(article_ids)
+
+    def history_matrix(self, histories):
+        # (users x articles) CSR matrix with the articles of every history
+        rows = [self.rows(hist) for hist in histories]
+        lengths = np.array([len(r) for r in rows])
+        cols = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        users = np.repeat(np.arange(len(histories)), lengths)
+        known = cols >= 0
+
+        return sp.csr_matrix((np.ones(known.sum(), dtype=np.float32), (users[known], cols[known])),
+                             shape=(len(histories), len(self.article_ids)))
+
+    def top_k_similar(self, queries, k=10, exclude=None, chunk_size=1000):
+        # `queries` is a sparse (n x features) matrix. Scores are computed
+        # chunk by chunk, so at most chunk_size x articles scores are held
+        # in memory. `exclude` is an optional (n x articles) sparse matrix of
+        # articles which must not be returned.
+        n = queries.shape[0]
+        k = min(k, len(self.article_ids))
+        articles = np.empty((n, k), dtype=np.int64)
+        scores = np.empty((n, k), dtype=np.float32)
+        matrix_t = self.matrix.T.tocsc()
+
+        for start in range(0, n, chunk_size):
+            chunk = (queries[start:start+chunk_size] @ matrix_t).toarray()
+            if exclude is not None:
+                ex = exclude[start:start+chunk_size].tocoo()
+                chunk[ex.row, ex.col] = -np.inf
+            articles[start:start+len(chunk)], scores[start:start+len(chunk)] = top_k(chunk, k)
+
+        return articles, scores
+
+    def similar_articles(self, article_ids, k=10, chunk_size=1000):
+        # the k most similar articles (article IDs) for every given article
+        rows = self.rows(article_ids)
+        assert (rows >= 0).all(), "some articles are not in the index"
+        exclude = sp.csr_matrix((np.ones(len(rows)), (np.arange(len(rows)), rows)),
+                                shape=(len(rows), len(self.article_ids)))
+        articles, scores = self.top_k_similar(self.matrix[rows], k=k, exclude=exclude,
+                                              chunk_size=chunk_size)
+
+        return self.article_ids.to_numpy()[articles], scores
+
+    def recommend(self, histories, k=10, exclude_read=True, chunk_size=1000):
+        # batched recommendations for many users: every user profile is the
+        # normalized sum of the vectors of the articles in the history
+        hist = self.history_matrix(histories)
+        profiles = normalize(hist @ self.matrix, norm='l2')
+        articles, scores = self.top_k_similar(profiles, k=k, exclude=hist if exclude_read else None,
+                                              chunk_size=chunk_size)
+
+        return self.article_ids.to_numpy()[articles], scores
@@ -1,40 +1,89 @@
+import os
 import numpy as np
-from lightfm.evaluation import precision_at_k, recall_at_k
-from lightfm.evaluation import  auc_score, reciprocal_rank
-
-
-def evaluate(model, train, test, hybrid=False, features=None):
-    
-    if hybrid:
-        auc_train = np.mean(auc_score(model, train, item_features=features))
-        pre_train = np.mean(precision_at_k(model, train, item_features=features))
-        mrr_train = np.mean(reciprocal_rank(model, train, item_features=features))
-        
-        auc_test = np.mean(auc_score(model, test, item_features=features))
-        pre_test = np.mean(precision_at_k(model, test, item_features=features))
-        mrr_test = np.mean(reciprocal_rank(model, test, item_features=features))   
-    else:
-        auc_train = np.mean(auc_score(model, train))
-        pre_train = np.mean(precision_at_k(model, train))
-        mrr_train = np.mean(reciprocal_rank(model, train))
-        
-        auc_test = np.mean(auc_score(model, test))
-        pre_test = np.mean(precision_at_k(model, test))
-        mrr_test = np.mean(reciprocal_rank(model, test))    
-    
-    res_dict = {'auc_train': auc_train, 
-                'pre_train': pre_train,
-                'mrr_train': mrr_train, 
-                'auc_test': auc_test, 
-                'pre_test': pre_test, 
-                'mrr_test': mrr_test}
-                  
-    print('The AUC Score is in training/validation:                 ',
-          auc_train,' / ', auc_test)
-    print('The mean precision at k Score in training/validation is: ',
-          pre_train, ' / ', pre_test)
-    print('The mean reciprocal rank in training/validation is:      ', 
-          mrr_train, ' / ', mrr_test)
-    print('_________________________________________________________')
-    
-    return res_dict
\ No newline at end of file
+import scipy.sparse as sp
+
+# prints the evaluation results, can be replaced by another logging function
+log = print
+
+
+def subsample_users(interactions, n_users, random_seed=None):
+    # keeps the interactions of `n_users` random users (with interactions)
+    interactions = interactions.tocsr()
+    users = np.flatnonzero(np.diff(interactions.indptr))
+    if n_users is None or n_users >= len(users):
+        return interactions
+
+    rng = np.random.default_rng(random_seed)
+    keep = np.zeros(interactions.shape[0])
+    keep[rng.choice(users, n_users, replace=False)] = 1
+
+    sampled = (sp.diags(keep) @ interactions).tocsr()
+    sampled.eliminate_zeros()
+
+    return sampled
+
+
+def rank_metrics(ranks, num_items, k=10):
+    # AUC, precision@k, recall@k and reciprocal rank per user (with
+    # interactions), all derived from the ranks of the positive items
+    # as returned by LightFM.predict_rank. Same definitions as in
+    # lightfm.evaluation.
+    ranks = ranks.tocsr()
+    n_pos = np.diff(ranks.indptr)
+    users = np.flatnonzero(n_pos)
+    rows = np.repeat(np.arange(ranks.shape[0]), n_pos)
+
+    hits = np.bincount(rows, weights=ranks.data < k, minlength=ranks.shape[0])
+
+    # for the AUC every positive is only compared with the negatives: the
+    # i-th best positive of a user has i other positives ranked above it
+    order = np.lexsort((ranks.data, rows))
+    above = np.arange(len(rows)) - ranks.indptr[rows]
+    negatives = np.maximum(num_items - n_pos[rows], 1)
+    auc = np.bincount(rows, weights=1 - (ranks.data[order] - above) / negatives,
+                      minlength=ranks.shape[0])
+    auc[n_pos == num_items] = 0.5 * num_items
+    best_rank = np.full(ranks.shape[0], np.inf)
+    np.minimum.at(best_rank, rows, ranks.data)
+
+    return {'auc': auc[users] / n_pos[users],
+            'pre': hits[users] / k,
+            'rec': hits[users] / n_pos[users],
+            'mrr': 1 / (best_rank[users] + 1)}
+
+
+def confidence_interval(values, z=1.96):
+    return z * np.std(values) / np.sqrt(max(len(values), 1))
+
+
+def evaluate(model, train, test, hybrid=False, features=None, k=10, num_threads=None,
+             sample_users=None, random_seed=None):
+    # one predict_rank pass per split (instead of one per metric): every
+    # user's full item ranking is computed once, across `num_threads`
+    # threads, and all metrics are derived from it. With `sample_users` the
+    # metrics are estimated on a seeded user subsample, the 95% confidence
+    # intervals are returned with the '_ci' suffix.
+    num_threads = num_threads or os.cpu_count()
+    item_features = features if hybrid else None
+
+    res_dict = {}
+    for split, interactions in (('train', train), ('test', test)):
+        interactions = subsample_users(interactions, sample_users, random_seed)
+        ranks = model.predict_rank(interactions, item_features=item_features,
+                                   num_threads=num_threads)
+        metrics = rank_metrics(ranks, interactions.shape[1], k=k)
+        for name, values in metrics.items():
+            res_dict[f'{name}_{split}'] = np.mean(values)
+            res_dict[f'{name}_{split}_ci'] = confidence_interval(values)
+
+    log('The AUC Score is in training/validation:                 ',
+        res_dict['auc_train'],' / ', res_dict['auc_test'])
+    log('The mean precision at k Score in training/validation is: ',
+        res_dict['pre_train'], ' / ', res_dict['pre_test'])
+    log('The mean recall at k Score in training/validation is:    ',
+        res_dict['rec_train'], ' / ', res_dict['rec_test'])
+    log('The mean reciprocal rank in training/validation is:      ',
+        res_dict['mrr_train'], ' / ', res_dict['mrr_test'])
+    log('_________________________________________________________')
+
+    return res_dict
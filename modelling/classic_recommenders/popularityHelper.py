@@ -0,0 +1,176 @@
+import heapq
+import numpy as np
+
+
+class MaxTree:
+    # complete binary tree of maxima over an array of non-negative values:
+    # tree[1] is the maximum of all values, leaves are tree[size:size+n].
+    # Changed values are propagated upwards level by level for all changed
+    # leaves at once; top_k is a best-first search, so it pops O(k) nodes
+    # from a heap and costs O(k log n).
+
+    def __init__(self, values):
+        self.n = len(values)
+        self.size = 1 << max(self.n - 1, 0).bit_length()
+        self.tree = np.zeros(2 * self.size)
+        self.tree[self.size:self.size+self.n] = values
+        for level_start in (self.size >> i for i in range(1, self.size.bit_length())):
+            nodes = np.arange(level_start, 2 * level_start)
+            self.tree[nodes] = np.maximum(self.tree[2*nodes], self.tree[2*nodes+1])
+
+    def update(self, leaves, values):
+        nodes = np.asarray(leaves) + self.size
+        self.tree[nodes] = values
+        nodes = np.unique(nodes // 2)
+        while len(nodes) and nodes[0] > 0:
+            self.tree[nodes] = np.maximum(self.tree[2*nodes], self.tree[2*nodes+1])
+            nodes = np.unique(nodes // 2)
+
+    def scale(self, factor):
+        self.tree *= factor
+
+    def top_k(self, k, exclude=()):
+        # the (at most) k leaves with the largest positive values
+        exclude = set(int(e) for e in exclude)
+        leaves, values = [], []
+        heap = [(-self.tree[1], 1)]
+        while heap and len(leaves) < k:
+            value, node = heapq.heappop(heap)
+            if node >= self.size:
+                leaf = node - self.size
+                if leaf < self.n and leaf not in exclude and value < 0:
+                    leaves.append(leaf)
+                    values.append(-value)
+            else:
+                heapq.heappush(heap, (-self.tree[2*node], 2*node))
+                heapq.heappush(heap, (-self.tree[2*node+1], 2*node+1))
+
+        return np.array(leaves, dtype=np.int64), np.array(values)
+
+
+class TrendingIndex:
+    # exponentially time-decayed click and impression counters per article,
+    # with half-life `half_life` (in seconds). All counters are stored
+    # relative to a common reference time t0: an event at time s adds
+    # exp(lambda * (s - t0)), and the counter at time t is the stored value
+    # times exp(-lambda * (t - t0)). So the decay never has to be applied to
+    # all articles, updates with events in any order are exact, and the order
+    # of the articles by decayed clicks only changes on updates, which keeps
+    # a MaxTree over the stored clicks valid for every t.
+
+    def __init__(self, n_articles=0, half_life=6 * 3600, impression_prior=100.0, max_exponent=30.0):
+        self.decay = np.log(2) / half_life
+        self.impression_prior = impression_prior
+        self.max_exponent = max_exponent
+        self.t0 = None
+        self.last_time = None
+        self.clicks = np.zeros(n_articles)
+        self.impressions = np.zeros(n_articles)
+        self.tree = MaxTree(self.clicks)
+
+    @property
+    def n_articles(self):
+        return len(self.clicks)
+
+    def _grow(self, n_articles):
+        # room for articles, which were published after the index was created
+        size = max(n_articles, 2 * self.n_articles)
+        self.clicks = np.concatenate((self.clicks, np.zeros(size - self.n_articles)))
+        self.impressions = np.concatenate((self.impressions, np.zeros(size - len(self.impressions))))
+        self.tree = MaxTree(self.clicks)
+
+    def _rebase(self, t):
+        # moves t0 to t, before the weights exp(lambda * (s - t0)) get too large
+        factor = np.exp(-self.decay * (t - self.t0))
+        self.clicks *= factor
+        self.impressions *= factor
+        self.tree.scale(factor)
+        self.t0 = t
+
+    def update(self, times, articles, clicks):
+        # impression events: the time (in seconds) when `articles[i]` was shown
+        # and whether it was clicked (clicks[i] = 1)
+        times = np.asarray(times, dtype=np.int64)
+        articles = np.asarray(articles, dtype=np.int64)
+        clicks = np.asarray(clicks)
+        if len(times) == 0:
+            return self
+
+        if self.t0 is None:
+            self.t0 = int(times.min())
+        if self.decay * (times.max() - self.t0) > self.max_exponent:
+            self._rebase(int(times.max()))
+        if articles.max() >= self.n_articles:
+            self._grow(int(articles.max()) + 1)
+
+        weights = np.exp(self.decay * (times - self.t0))
+        self.impressions += np.bincount(articles, weights=weights, minlength=self.n_articles)
+        clicked = clicks == 1
+        changed = np.unique(articles[clicked])
+        self.clicks += np.bincount(articles[clicked], weights=weights[clicked], minlength=self.n_articles)
+        self.tree.update(changed, self.clicks[changed])
+        self.last_time = int(times.max()) if self.last_time is None else max(self.last_time, int(times.max()))
+
+        return self
+
+    def _factor(self, t):
+        if self.t0 is None:
+            return 1.0
+        t = self.last_time if t is None else t
+        return np.exp(-self.decay * (t - self.t0))
+
+    def scores(self, t=None, by='clicks'):
+        # decayed counters of all articles at time t (default: time of the last event)
+        factor = self._factor(t)
+        if by == 'clicks':
+            return self.clicks * factor
+        if by == 'impressions':
+            return self.impressions * factor
+        if by == 'ctr':
+            # click-through rate, smoothed with `impression_prior` pseudo
+            # impressions at the overall CTR, so articles with only a few
+            # impressions don't come out on top by chance
+            overall = self.clicks.sum() / max(self.impressions.sum(), 1e-12)
+            return ((self.clicks * factor + self.impression_prior * overall)
+                    / (self.impressions * factor + self.impression_prior))
+        raise ValueError(f"unknown score {by}, choose from 'clicks', 'impressions' or 'ctr'")
+
+    def trending(self, k=10, t=None, by='clicks', exclude=()):
+        # the k articles with the most decayed clicks at time t in
+        # O(k log n), or with the highest smoothed CTR (by='ctr', O(n)).
+        # Only events up to the last update count, so t should not be earlier.
+        # `exclude` are articles (e.g. already read), which are skipped.
+        if by == 'clicks':
+            articles, values = self.tree.top_k(k, exclude=exclude)
+            return articles, values * self._factor(t)
+
+        scores = self.scores(t, by=by)
+        scores[np.asarray(list(exclude), dtype=np.int64)] = -np.inf
+        k = min(k, len(scores))
+        part = np.argpartition(-scores, k - 1)[:k] if k else np.zeros(0, dtype=np.int64)
+        order = np.argsort(-scores[part], kind='stable')
+
+        return part[order], scores[part[order]]
+
+
+def stream_impressions(arrays, window=3600):
+    # replays the impressions of the encoded behaviors arrays (see
+    # load_behaviors_arrays) in order of time: yields (end of window, times,
+    # articles, clicks) for consecutive windows of `window` seconds
+    session_times = np.asarray(arrays['time'])
+    indptr = np.asarray(arrays['impressions_indptr'])
+    order = np.argsort(session_times, kind='stable')
+    sorted_times = session_times[order]
+
+    if len(sorted_times) == 0:
+        return
+    for start in range(int(sorted_times[0]), int(sorted_times[-1]) + 1, window):
+        lo, hi = np.searchsorted(sorted_times, [start, start + window])
+        if lo == hi:
+            continue
+        sessions = order[lo:hi]
+        lengths = indptr[sessions + 1] - indptr[sessions]
+        positions = np.repeat(indptr[sessions] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        yield (start + window, np.repeat(session_times[sessions], lengths),
+               np.asarray(arrays['impressions_indices'])[positions],
+               np.asarray(arrays['impressions_labels'])[positions])
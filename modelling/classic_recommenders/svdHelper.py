@@ -0,0 +1,84 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import LinearOperator, svds
+
+from rankingHelper import top_k
+
+
+def centered_operator(matrix, row_means):
+    # the row-centered matrix (matrix - row_means * 1^T) as a linear operator,
+    # so the centering never densifies the sparse matrix
+    n_items = matrix.shape[1]
+    matrix_t = matrix.T.tocsr()
+
+    def matvec(x):
+        x = np.asarray(x).reshape(n_items, -1)
+        return matrix @ x - np.outer(row_means, x.sum(axis=0))
+
+    def rmatvec(y):
+        y = np.asarray(y).reshape(len(row_means), -1)
+        return matrix_t @ y - np.outer(np.ones(n_items), row_means @ y)
+
+    return LinearOperator(matrix.shape, matvec=matvec, rmatvec=rmatvec,
+                          matmat=matvec, rmatmat=rmatvec, dtype=np.float64)
+
+
+class SparseSVDRecommender:
+    # truncated SVD collaborative filtering on the CSR user-article matrix,
+    # as in collaborative_filtering.ipynb (row-mean centering, svds), but
+    # without a dense user x article matrix at any point: the centering is
+    # implicit, and predictions are only computed for one batch of users
+    # at a time.
+
+    def __init__(self, k=50, center=True, random_seed=None):
+        self.k = k
+        self.center = center
+        self.random_seed = random_seed
+
+    def fit(self, matrix):
+        self.matrix = sp.csr_matrix(matrix, dtype=np.float64)
+        n_users, n_items = self.matrix.shape
+
+        if self.center:
+            self.row_means = np.asarray(self.matrix.sum(axis=1)).ravel() / n_items
+            operator = centered_operator(self.matrix, self.row_means)
+        else:
+            self.row_means = np.zeros(n_users)
+            operator = self.matrix
+
+        v0 = np.random.default_rng(self.random_seed).random(min(n_users, n_items))
+        U, sigma, Vt = svds(operator, k=self.k, v0=v0)
+
+        # svds returns the singular values in ascending order
+        order = np.argsort(-sigma)
+        self.user_factors = np.ascontiguousarray((U[:, order] * sigma[order]), dtype=np.float32)
+        self.item_factors = np.ascontiguousarray(Vt[order], dtype=np.float32)
+        self.sigma = sigma[order]
+
+        return self
+
+    def predict(self, users):
+        # reconstructed (approximated) rows of the given users
+        users = np.asarray(users)
+        return self.user_factors[users] @ self.item_factors + self.row_means[users, None]
+
+    def recommend(self, users=None, k=10, exclude_seen=True, batch_size=1000):
+        # top-k articles per user, computed batch by batch, so memory is
+        # bounded by batch_size x articles. Returns (articles, scores).
+        users = np.arange(self.matrix.shape[0]) if users is None else np.atleast_1d(users)
+        k = min(k, self.matrix.shape[1])
+        articles = np.empty((len(users), k), dtype=np.int64)
+        scores = np.empty((len(users), k), dtype=np.float32)
+
+        for start in range(0, len(users), batch_size):
+            batch = users[start:start+batch_size]
+            # the row mean does not change the ranking within a row, so it is
+            # only added to the selected scores
+            batch_scores = self.user_factors[batch] @ self.item_factors
+            if exclude_seen:
+                seen = self.matrix[batch].tocoo()
+                batch_scores[seen.row, seen.col] = -np.inf
+            articles[start:start+len(batch)], scores[start:start+len(batch)] = top_k(batch_scores, k)
+            scores[start:start+len(batch)] += self.row_means[batch, None]
+
+        return articles, scores
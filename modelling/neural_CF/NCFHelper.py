@@ -1,13 +1,19 @@
+import os
+import sys
 import math
 import numpy as np
 import heapq
 
+# the negative sampling is shared with the preprocessing
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "preprocessing"))
+from samplingHelper import sample_negatives
+
 def eval_one_rating(idx, model, test_positives, test_negatives, K=10):
     rating = test_positives[idx]
     items = test_negatives[idx]
     u = rating[0]
     get_item = rating[1]
-    items.append(get_item)
+    items = list(items) + [get_item]
     # Get prediction scores
     map_item_score = {}
     users = np.full(len(items), u, dtype = 'int32')
@@ -16,7 +22,6 @@ def eval_one_rating(idx, model, test_positives, test_negatives, K=10):
     for i in range(len(items)):
         item = items[i]
         map_item_score[item] = predictions[i]
-    items.pop()
     
     # Evaluate top rank list
     ranklist = heapq.nlargest(K, map_item_score, key=map_item_score.get)
@@ -31,4 +36,81 @@ def eval_one_rating(idx, model, test_positives, test_negatives, K=10):
         ndcg = 0
         rr = 0
    
-    return (hr, ndcg, rr)
\ No newline at end of file
+    return (hr, ndcg, rr)
+
+
+def evaluate_ratings(model, test_positives, test_negatives, K=10,
+                     users_per_batch=10_000, batch_size=100_000):
+    # batched version of eval_one_rating: the (user, item) candidates of many
+    # test users are scored in a few large predict calls, and the rank of the
+    # test item within its 100 candidates is computed for all users at once.
+    # As in eval_one_rating, negatives with the same score as the test item
+    # are ranked before it (unless the negative is the test item itself), and
+    # a negative which was drawn several times counts only once.
+    # Returns arrays of hits, ndcgs and rrs per user.
+    positives = np.asarray(test_positives, dtype=np.int32)
+    negatives = np.asarray(test_negatives, dtype=np.int32)
+    num_users = len(positives)
+
+    ranks = np.empty(num_users, dtype=np.int64)
+    for start in range(0, num_users, users_per_batch):
+        pos = positives[start:start+users_per_batch]
+        batch_negatives = np.sort(negatives[start:start+users_per_batch], axis=1)
+        items = np.column_stack((batch_negatives, pos[:, 1]))
+        users = np.repeat(pos[:, 0], items.shape[1])
+
+        scores = model.predict([users, items.ravel()], batch_size=batch_size, verbose=0)
+        scores = np.asarray(scores).reshape(items.shape)
+        first = np.ones(batch_negatives.shape, dtype=bool)
+        first[:, 1:] = batch_negatives[:, 1:] != batch_negatives[:, :-1]
+        ahead = first & (scores[:, :-1] >= scores[:, -1:]) & (batch_negatives != pos[:, 1:])
+        ranks[start:start+len(pos)] = ahead.sum(axis=1)
+
+    hits = (ranks < K).astype(np.float64)
+    ndcgs = np.where(ranks < K, math.log(2) / np.log(ranks + 2), 0)
+    rrs = np.where(ranks < K, 1 / (ranks + 1), 0)
+
+    return hits, ndcgs, rrs
+
+
+def ncf_batch_generator(train, np_ratio=4, batch_size=256, random_seed=None):
+    # streams shuffled ([users, articles], labels) batches from the CSR
+    # `train` matrix: every batch holds `batch_size` positive interactions,
+    # each followed by `np_ratio` negatives, which are sampled freshly for
+    # every epoch. Returns the generator function and the number of batches
+    # per epoch.
+    rng = np.random.default_rng(random_seed)
+    users, articles = train.nonzero()
+    users, articles = users.astype(np.int32), articles.astype(np.int32)
+
+    labels = np.zeros((batch_size, np_ratio + 1), dtype=np.float32)
+    labels[:, 0] = 1
+
+    def generator():
+        order = rng.permutation(len(users))
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start+batch_size]
+            batch_users = users[batch]
+            negatives = sample_negatives(train, batch_users, np_ratio, seed=rng)
+
+            user_input = np.repeat(batch_users, np_ratio + 1)
+            article_input = np.column_stack((articles[batch], negatives)).ravel()
+            yield (user_input, article_input), labels[:len(batch)].ravel()
+
+    return generator, math.ceil(len(users) / batch_size)
+
+
+def ncf_dataset(train, np_ratio=4, batch_size=256, random_seed=None):
+    # tf.data wrapper around ncf_batch_generator: the generator is called
+    # again for every epoch and batches are prefetched in the background
+    import tensorflow as tf
+
+    generator, steps_per_epoch = ncf_batch_generator(train, np_ratio=np_ratio,
+                                                     batch_size=batch_size,
+                                                     random_seed=random_seed)
+    signature = ((tf.TensorSpec(shape=(None,), dtype=tf.int32),
+                  tf.TensorSpec(shape=(None,), dtype=tf.int32)),
+                 tf.TensorSpec(shape=(None,), dtype=tf.float32))
+    dataset = tf.data.Dataset.from_generator(generator, output_signature=signature)
+
+    return dataset.prefetch(tf.data.AUTOTUNE), steps_per_epoch
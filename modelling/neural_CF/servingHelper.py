@@ -0,0 +1,122 @@
+import numpy as np
+
+from rankingHelper import top_k
+
+# names of the embedding layers in the GMF / NCF (MLP) and NeuMF notebooks
+EMBEDDING_LAYERS = {'gmf': ('user_embedding', 'article_embedding'),
+                    'mlp': ('user_embedding', 'article_embedding'),
+                    'neumf': ('mf_user_embedding', 'mf_article_embedding')}
+
+
+def export_embeddings(model, model_type='gmf', layers=None, prediction_layer='prediction'):
+    # copies the learned user and article embedding tables out of the keras
+    # model into contiguous float32 arrays. GMF scores sigmoid(h . (p_u * q_i) + b),
+    # so the weights h of the prediction layer are folded into the user
+    # table: then p_u' . q_i orders the articles exactly like the model. For
+    # NeuMF the same is done with the MF part of the prediction kernel (its
+    # first rows, the MF vector comes first in the concatenation).
+    user_layer, article_layer = layers or EMBEDDING_LAYERS[model_type]
+    user_emb = model.get_layer(user_layer).get_weights()[0]
+    article_emb = model.get_layer(article_layer).get_weights()[0]
+    if model_type in ('gmf', 'neumf'):
+        kernel = model.get_layer(prediction_layer).get_weights()[0]
+        user_emb = user_emb * kernel[:user_emb.shape[1], 0]
+
+    return (np.ascontiguousarray(user_emb, dtype=np.float32),
+            np.ascontiguousarray(article_emb, dtype=np.float32))
+
+
+def save_embeddings(path, user_emb, article_emb):
+    np.save(path + "user_embeddings.npy", user_emb)
+    np.save(path + "article_embeddings.npy", article_emb)
+
+
+def load_embeddings(path, mmap_mode='r'):
+    return (np.load(path + "user_embeddings.npy", mmap_mode=mmap_mode),
+            np.load(path + "article_embeddings.npy", mmap_mode=mmap_mode))
+
+
+class TopKRecommender:
+    # top-K retrieval on exported embeddings: a user is scored against all
+    # articles with one matrix product instead of the full keras graph.
+    # Articles in the user's row of the CSR `seen` matrix (e.g. the train
+    # matrix) are excluded. If a `model` is given, recommend_reranked scores
+    # a small candidate set from the dot products exactly with the model,
+    # which is how the MLP / NeuMF towers should be served.
+
+    def __init__(self, user_emb, article_emb, seen=None, model=None):
+        self.user_emb = np.ascontiguousarray(user_emb, dtype=np.float32)
+        self.article_emb_t = np.ascontiguousarray(np.asarray(article_emb, dtype=np.float32).T)
+        self.seen = seen
+        self.model = model
+
+    @property
+    def num_articles(self):
+        return self.article_emb_t.shape[1]
+
+    def scores(self, users):
+        return self.user_emb[np.asarray(users)] @ self.article_emb_t
+
+    def exclude_seen(self, users, scores):
+        # positions of all seen articles of the batch in the CSR arrays
+        indptr, indices = self.seen.indptr, self.seen.indices
+        starts = indptr[users]
+        lengths = indptr[users + 1] - starts
+        rows = np.repeat(np.arange(len(users)), lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        scores[rows, indices[np.repeat(starts, lengths) + offsets]] = -np.inf
+
+    def recommend(self, users, k=10, exclude_seen=True, batch_size=1024):
+        # returns (articles, scores), both of shape (len(users), k)
+        users = np.atleast_1d(np.asarray(users))
+        k = min(k, self.num_articles)
+        articles = np.empty((len(users), k), dtype=np.int64)
+        scores = np.empty((len(users), k), dtype=np.float32)
+
+        for start in range(0, len(users), batch_size):
+            batch = users[start:start+batch_size]
+            batch_scores = self.scores(batch)
+            if exclude_seen and self.seen is not None:
+                self.exclude_seen(batch, batch_scores)
+            articles[start:start+len(batch)], scores[start:start+len(batch)] = top_k(batch_scores, k)
+
+        return articles, scores
+
+    def recommend_reranked(self, users, k=10, num_candidates=200, exclude_seen=True,
+                           batch_size=1024, predict_batch_size=100_000):
+        # stage 1: `num_candidates` articles per user by embedding dot product,
+        # stage 2: exact scores of the model for these candidates only
+        assert self.model is not None, "re-ranking needs the keras model"
+        users = np.atleast_1d(np.asarray(users))
+        candidates, _ = self.recommend(users, k=num_candidates, exclude_seen=exclude_seen,
+                                       batch_size=batch_size)
+
+        user_input = np.repeat(users, candidates.shape[1]).astype(np.int32)
+        predictions = self.model.predict([user_input, candidates.ravel().astype(np.int32)],
+                                         batch_size=predict_batch_size, verbose=0)
+        exact = np.asarray(predictions, dtype=np.float32).reshape(candidates.shape)
+
+        order, scores = top_k(exact, k)
+        return np.take_along_axis(candidates, order, axis=1), scores
+
+    def check_against_model(self, users, k=10, exclude_seen=True, predict_batch_size=100_000):
+        # for a few users: the articles from recommend must have the k best
+        # scores of the model over all articles (compared by score, so ties
+        # may come in any order). Holds for GMF embeddings from
+        # export_embeddings, not for the MLP / NeuMF towers.
+        assert self.model is not None, "the check needs the keras model"
+        users = np.atleast_1d(np.asarray(users))
+        articles, _ = self.recommend(users, k=k, exclude_seen=exclude_seen)
+        all_articles = np.arange(self.num_articles, dtype=np.int32)
+
+        for user, recommended in zip(users, articles):
+            predictions = self.model.predict([np.full(self.num_articles, user, dtype=np.int32), all_articles],
+                                             batch_size=predict_batch_size, verbose=0)
+            predictions = np.asarray(predictions, dtype=np.float64).ravel()
+            if exclude_seen and self.seen is not None:
+                predictions[self.seen.indices[self.seen.indptr[user]:self.seen.indptr[user+1]]] = -np.inf
+            best = -np.sort(-predictions)[:len(recommended)]
+            assert np.allclose(predictions[recommended], best, rtol=1e-5, atol=1e-7), \
+                f"top-{k} of user {user} differs from the model's ranking"
+
+        return True
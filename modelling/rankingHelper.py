@@ -0,0 +1,16 @@
+import numpy as np
+
+# ranking utilities of the recommenders in the subdirectories. They import
+# this module directly, so modelling/ has to be on the path of the calling
+# script or notebook (e.g. sys.path.append("..")).
+
+
+def top_k(scores, k):
+    # indices and values of the k highest scores of every row, in descending
+    # order: argpartition selects them in O(n), only those k are sorted
+    k = min(k, scores.shape[1])
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+
+from profilingHelper import log, stage
+
+CACHE_VERSION = 1
+
+
+def file_hash(path_to_file, blocksize=1 << 20):
+    sha = hashlib.sha1()
+    with open(path_to_file, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+class StageCache:
+    # memoizes the results of preprocessing stages on disk. The key of a stage
+    # is built from its name, the content hashes of its input files, its
+    # parameters and the keys of the stages it depends on, so a stage is
+    # recomputed (and its old artifact removed) as soon as any of them
+    # changes. Hashes of input files are remembered by (size, mtime), so
+    # unchanged files are not read again.
+
+    def __init__(self, cache_dir, enabled=True):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.keys = {}
+        self.stats = []
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hashes_path = os.path.join(cache_dir, 'file_hashes.json')
+        if os.path.exists(self.hashes_path):
+            with open(self.hashes_path) as f:
+                self.file_hashes = json.load(f)
+        else:
+            self.file_hashes = {}
+
+    def input_hash(self, path_to_file):
+        path_to_file = os.path.abspath(path_to_file)
+        stat = os.stat(path_to_file)
+        signature = [stat.st_size, stat.st_mtime_ns]
+
+        entry = self.file_hashes.get(path_to_file)
+        if entry is None or entry['signature'] != signature:
+            entry = {'signature': signature, 'hash': file_hash(path_to_file)}
+            self.file_hashes[path_to_file] = entry
+            with open(self.hashes_path, 'w') as f:
+                json.dump(self.file_hashes, f)
+
+        return entry['hash']
+
+    def stage_key(self, name, inputs, deps, params):
+        description = {'version': CACHE_VERSION,
+                       'stage': name,
+                       'inputs': [self.input_hash(path) for path in inputs],
+                       'deps': [self.keys[dep] for dep in deps],
+                       'params': params}
+        encoded = json.dumps(description, sort_keys=True, default=str).encode()
+
+        return hashlib.sha1(encoded).hexdigest()[:16]
+
+    def artifact_path(self, name, key):
+        return os.path.join(self.cache_dir, f"{name}-{key}.pkl")
+
+    def remove_stale(self, name, key):
+        for fn in os.listdir(self.cache_dir):
+            if fn.startswith(name + '-') and fn.endswith('.pkl') and fn != f"{name}-{key}.pkl":
+                os.remove(os.path.join(self.cache_dir, fn))
+
+    def run(self, name, func, *args, inputs=(), deps=(), outputs=(), options=None, **params):
+        # runs func(*args, **options, **params) or loads its cached result.
+        # Positional args are not part of the key: files they refer to belong
+        # in `inputs`, results of other stages in `deps`. `options` are
+        # keyword arguments, which don't change the result (e.g. the number
+        # of workers) and are left out of the key as well. Files the stage
+        # writes as a side effect are listed in `outputs`; the cache is only
+        # used if they still exist.
+        start = time.perf_counter()
+        key = self.stage_key(name, inputs, deps, params)
+        self.keys[name] = key
+        path = self.artifact_path(name, key)
+
+        hit = self.enabled and os.path.exists(path) and all(os.path.exists(o) for o in outputs)
+        with stage(name) as record:
+            record.info['cache'] = 'hit' if hit else 'miss'
+            if hit:
+                with open(path, 'rb') as f:
+                    result = pickle.load(f)
+            else:
+                result = func(*args, **(options or {}), **params)
+                if self.enabled:
+                    self.remove_stale(name, key)
+                    with open(path, 'wb') as f:
+                        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        seconds = time.perf_counter() - start
+        self.stats.append({'stage': name, 'key': key, 'hit': hit, 'seconds': seconds})
+
+        return result
+
+    def report(self):
+        hits = sum(s['hit'] for s in self.stats)
+        log(f"Cache hits / misses: {hits} / {len(self.stats) - hits}")
+        for s in self.stats:
+            log(f"  {s['stage']:<25} {'hit ' if s['hit'] else 'miss'} {s['seconds']:>8.2f}s")
+
+        return self.stats
@@ -3,193 +3,157 @@
 
 # # Preprocessing and Cleaning of the Data
 
-import pandas as pd
+import os
 import numpy as np
-import pickle
-import scipy.sparse as sp
 
-from progressbar import ProgressBar
+from preprocessingHelper import (import_news, canonical_article_ids, duplicate_article_dict,
+                                 stream_behaviors, user_article_interactions)
+from dedupHelper import add_near_duplicate_ids
+from interactionHelper import build_interaction_matrix
+from samplingHelper import sample_negatives
+from cacheHelper import StageCache
+from embeddingHelper import load_vec, pool_entities
+from profilingHelper import configure, log, stage
 
-pickle_matrix = False
 # ## Choose whether to load the small or large dataset
 
 # Choose from "small" or "large"
 dataset_size = "large"
 # Choose from "train" or "dev" (test)
 dataset_type = "train"
+# Minimum number of articles in a user's history
+min_history = 5
+# Number of sessions which are read from behaviors.tsv at once
+chunksize = 100_000
+# Number of processes, which clean the chunks of behaviors.tsv in parallel
+workers = 1
+# Whether to also write the integer encoded (memory-mappable) behaviors arrays
+save_arrays = True
+# Minimum (estimated) Jaccard similarity of the title + abstract shingles of
+# two articles to be merged as near duplicates (None: only identical titles)
+near_duplicate_threshold = 0.8
+# Seed for the sampling of the test negatives
+seed = 420
+# Whether to reuse the results of unchanged stages from earlier runs
+use_cache = True
+# Whether to print progress output (False for batch jobs)
+verbose = True
+# Stages which are run under cProfile, e.g. ["behaviors"] or "all"
+profile_stages = []
 
 dataset_path = f"../../data/mind_{dataset_size}_{dataset_type}/"
 behaviors_path = dataset_path + "behaviors.tsv"
 news_path = dataset_path + "news.tsv"
 
+# Every expensive stage below runs through a **stage cache**: its result is stored in the cache directory, keyed on the hashes of the input files, the stage parameters and the stages it depends on. So re-running this script on unchanged data only loads the results again.
 
-# ## Loading the data
+cache = StageCache(dataset_path + "cache/", enabled=use_cache)
 
-behaviors = pd.read_csv(behaviors_path, sep='\t', header=None)
-news = pd.read_csv(news_path, sep='\t', header=None)
+# Every stage is also timed by the profiler (wall and CPU time, peak memory), which writes a JSON report at the end of this script. Its cProfile dumps go to the `profiles/` directory.
 
+profiler = configure(verbose=verbose, profile_stages=profile_stages,
+                     profile_dir=dataset_path + "profiles/")
 
-# Let's first give our datasets some proper column names:
 
-behaviors = behaviors.rename(columns={0: 'impression_id', 
-                                      1: 'user_id', 
-                                      2: 'time', 
-                                      3: 'history', 
-                                      4: 'impressions'})
+# ## Loading the data
+# The news dataset is small enough to be loaded as a whole. The behaviors dataset on the other hand is **streamed in chunks** (see below), so that we never hold more than `chunksize` sessions in memory at once.
 
-news = news.rename(columns={0: 'article_id', 
-                            1: 'category', 
-                            2: 'subcategory', 
-                            3: 'title', 
-                            4: 'abstract', 
-                            5: 'url', 
-                            6: 'title_entities', 
-                            7: 'abstract_entities'})
+news = cache.run("news", import_news, news_path, inputs=[news_path])
 
 news_shape = news.shape
-print(f"\nShape of news dataset: {news_shape}")
-print(f"There are more than {news_shape[0]//1000},000 news articles in our news dataset.")
+log(f"\nShape of news dataset: {news_shape}")
+log(f"There are more than {news_shape[0]//1000},000 news articles in our news dataset.")
 
 # For every article we have information concerning the **news category, subcategory, it's title, abstract and even some entitiy embeddings** (most of the urls don't work anymore so we don't have access to the full bodies). Let's check whether these are all unique articles or if we also have some duplicates:
 
-print("Number of unique news articles: ", news.title.nunique())
-print("Number of duplicates:             ", news.shape[0] - news.title.nunique())
-
-
-# Apparently, there are **news articles with multiple IDs**. We don't just want to drop them yet, as this would result in a loss of useful information concerning the click behaviors and reading histories in our ***behaviors* dataset**, which looks like this:
-
-# Let us first prepare this dataset before we get back to handling the duplicate news articles.
-
-# ## Preparing the *behaviors* dataset
-
-behaviors_shape = behaviors.shape
-print(f"\nShape of behaviors dataset: {behaviors_shape}")
-print(f"In the behaviors dataset there are more than {behaviors_shape[0]//1000},000",
-      "online sessions from MSN news.")
-
-
-# We have information concerning **user ID, date and daytime, the click history, and the recommended articles and user behavior** (ending on -1 = clicked) for the respective session. Let's see how many unique users there are:
-
-print(f'There are {len(behaviors.user_id.unique())} individual users in our dataset.')
-print(f'The average number of sessions is: {behaviors_shape[0] / len(behaviors.user_id.unique()):.1f}')
+log("Number of unique news articles: ", news.title.nunique())
+log("Number of duplicates:             ", news.shape[0] - news.title.nunique())
 
-# we want to include **only users with at least five articles read** in their history. So we need to drop ahistorical users as well as users with too few articles read:
 
-behaviors.dropna(inplace=True)
+# Apparently, there are **news articles with multiple IDs**. We don't just want to drop them yet, as this would result in a loss of useful information concerning the click behaviors and reading histories in our ***behaviors* dataset**.
+#
+# Besides the identical titles there are also **near duplicates**: republished articles with a slightly edited title or abstract. These are found with **MinHash LSH** on the word 3-shingles of title and abstract: similar articles land in the same bucket of at least one signature band, the candidates are verified with their signatures, and every cluster of near duplicates (including the identical titles) gets the ID of its first article in the `canonical_id` column.
 
-behaviors['length_history'] = behaviors.history.str.split().map(len)
-
-behaviors = behaviors[behaviors['length_history'] >= 5]
+news_stage = "news"
+near_duplicates, news_signatures = None, None
+if near_duplicate_threshold is not None:
+    near_duplicates = {'threshold': near_duplicate_threshold}
+    news, news_signatures = cache.run("near_duplicates", add_near_duplicate_ids, news, deps=["news"],
+                                      return_signatures=True, **near_duplicates)
+    news_stage = "near_duplicates"
 
 # ## Droppping duplicate article IDs in *news* and remapping them in *behaviors*
-# Now that we have set up our *behaviors* dataset with respect to users, let's get back to the duplicate news articles. With different IDs for the de facto same articles we would not be able to track similarities among users sufficiently. In the following, we will **replace every redundant article-ID with the first ID for the respective article**. In order to this, we first create a subset with all the duplicates in it:
-
-duplis_title = news[news.duplicated(subset="title", keep=False)]
-
-duplis_title.sort_values(by="title").head(3)
-
-title_set = duplis_title['title'].unique()
-
-article_list = []
-for title in title_set:
-    x = duplis_title[duplis_title['title']==title]['article_id'].to_list()
-    article_list.append(x)
-
-# We now have a **list which contains article IDs for every article which has multiple IDs** in our original dataset. With this list, we can generate a dictionary called articleID_dict, which maps all the redundant IDs (keys) to a single ID (value):
-
-articleID_dict = {}
-articles_to_change = []
-for article in article_list:
-    value = article[0]
-    keys = article [1:]
-    for k in keys:
-        articleID_dict[k] = value
-        articles_to_change.append(k)
-
-
-# Let's make a copy of the original behaviors dataframe and make it to a numpy array, so that we can **loop through all the redundant IDs in the *behaviors* dataset and homogenize them** according to our dictionary:
-
-behav = behaviors.copy()
-behav = behav.to_numpy()
-
-pbar = ProgressBar()
-userIDs_hist_changes = []
-userIDs_impr_changes = []
-users_to_change = []
-articles_to_change_set = set(articles_to_change)
-
-for idx in pbar(range(behav.shape[0])):
-    user_row = behav[idx]
-    hist_flag = False
-    hist = user_row[3]
-    hist_list = hist.split()
-    hist_set = set(hist_list)
-    hist_inter = hist_set & articles_to_change_set
-    for art in hist_inter:
-        hist_flag = True
-        users_to_change.append(idx)
-        userIDs_hist_changes.append(user_row[1])
-        hist = hist.replace(art, articleID_dict[art])
-    if hist_flag:
-        behav[idx][3] = hist
-    impression_flag = False
-    impressions = user_row[4]
-    impression_list = [l[:-2] for l in impressions.split()]
-    impression_set = set(impression_list)
-    for art in (impression_set & articles_to_change_set):
-        impression_flag = True
-        userIDs_impr_changes.append(user_row[1])
-        impressions = impressions.replace(art, articleID_dict[art])
-    if impression_flag:        
-        behav[idx][4] = impressions
-
-# ## Dropping users who read articles on which there is no information
-# 
-# We realized, that there are some articles in the history and impression logs without a corresponding entry in the news dataset. So, before saving the processed datasets, we also remove all the users in the behaviors dataset, who read those articles:
-
-unique_articles_behav = set(all_articles)
+# With different IDs for the de facto same articles we would not be able to track similarities among users sufficiently. In the following, we will **replace every redundant article-ID with the first ID for the respective article**. For this we group the news articles by title (or by their near duplicate cluster), which gives us a dictionary that maps all the redundant IDs (keys) to a single ID (value):
 
-unique_articles_news = set(news.article_id.unique())
+articleID_dict = duplicate_article_dict(news)
+log(f"{len(articleID_dict)} redundant article IDs will be remapped.")
 
-articles_to_drop = unique_articles_behav - unique_articles_news
+# In the behaviors dataset the remapping works on the level of single article IDs (so `N1234` is never mistaken for a part of `N12345`): every article ID is interned to an integer code and looked up in an array of canonical codes. 
+#
+# We also realized, that there are some articles in the history and impression logs without a corresponding entry in the news dataset. Those articles don't get a code, so we can directly remove all the sessions in the behaviors dataset, which contain them.
 
-users_to_drop = []
-for i, impr in enumerate(behav):
-    hist_set = set(impr[3].split())
-    if len(hist_set & articles_to_drop) > 0:
-        users_to_drop.append(i)
-    
-    impr_set = set([art[:-2] for art in impr[4].split()])
-    if len(impr_set & articles_to_drop) > 0:
-        users_to_drop.append(i)
-
-users_to_drop = list(set(users_to_drop))
-
-behav_new = np.delete(behav, users_to_drop, axis=0)
+# ## Preparing the *behaviors* dataset
+# We have information concerning **user ID, date and daytime, the click history, and the recommended articles and user behavior** (ending on -1 = clicked) for the respective session. We want to include **only users with at least five articles read** in their history, homogenize the redundant IDs according to our dictionary and drop the sessions with unknown articles.
+#
+# All of this happens **chunk by chunk**: every cleaned chunk is directly appended to `behaviors_processed.csv`, and only the first session of every user is kept in memory for the collaborative filtering preprocessing below.
 
-# Now let's make a **new dataframe out of our processed behavioral data**:
+# Besides the csv file we also write an **integer encoded version** of the processed behaviors: a user and article vocabulary plus CSR-style `indptr`/`indices` arrays for the histories, impressions and click labels. These are stored as .npy files, so later on they can simply be memory-mapped with `load_behaviors_arrays` instead of parsing the csv and splitting strings again.
+#
+# The arrays also contain all reads (history and clicked articles) as user and article code arrays, which `load_behaviors_arrays` turns into the binary user x article `interactions` matrix. Vocabularies and arrays are **append-only**: a new day of logs is added with `ingestionHelper.ingest_day(behaviors_path, news_path, behaviors_arrays_path)`, which keeps all existing codes, only processes the new sessions and articles and appends them to the stored files without rewriting them. The new articles are deduplicated with the same settings, so the arrays store the near duplicate threshold and the MinHash signatures of the articles, too.
 
-behaviors_new = pd.DataFrame(behav_new, columns=behaviors.columns)
+behaviors_output_path = dataset_path + "behaviors_processed.csv"
+behaviors_arrays_path = dataset_path + "behaviors_processed_arrays/" if save_arrays else None
+
+behaviors_outputs = [behaviors_output_path] + ([behaviors_arrays_path] if save_arrays else [])
+# the signatures are determined by the near_duplicates stage, so they are no
+# part of the cache key
+behaviors_cf, behaviors_stats = cache.run("behaviors", stream_behaviors,
+                                          behaviors_path, behaviors_output_path, news,
+                                          inputs=[behaviors_path], deps=[news_stage],
+                                          outputs=behaviors_outputs,
+                                          options={'chunksize': chunksize, 'workers': workers,
+                                                   'signatures': news_signatures},
+                                          min_history=min_history,
+                                          arrays_path=behaviors_arrays_path,
+                                          near_duplicates=near_duplicates)
+
+# the shard throughput is only meaningful if the stage ran now, `workers`
+# and `chunksize` are not part of the cache key
+if not cache.stats[-1]['hit']:
+    shard_rates = [shard['rows_per_s'] for shard in behaviors_stats['shards']]
+    log(f"Cleaned {behaviors_stats['chunks']} shards with {workers} worker(s),",
+        f"{min(shard_rates, default=0):,.0f} to {max(shard_rates, default=0):,.0f} rows/s per shard.")
+
+log(f"\nIn the behaviors dataset there were more than {behaviors_stats['sessions_in']//1000},000",
+    "online sessions from MSN news.")
 
 # After the processing from above, the numbers for our *behaviors* dataset now look like this:
 
-print(f'There are now just over {behaviors_new.shape[0]//1000},000 sessions and {len(behaviors_new.user_id.unique())}',
-      'individual users in our dataset.')
-print(f'The average number of sessions is: {behaviors_new.shape[0] / len(behaviors_new.user_id.unique()):.1f}')
+log(f"There are now just over {behaviors_stats['sessions_out']//1000},000 sessions and {behaviors_stats['users_out']}",
+    'individual users in our dataset.')
+log(f"The average number of sessions is: {behaviors_stats['sessions_out'] / max(behaviors_stats['users_out'], 1):.1f}")
 
 # And also make a new dataframe for the information on **news articles without duplicates**:
 
-news_new = news.drop_duplicates(subset="title", keep='first')
+news_new = news[canonical_article_ids(news) == news.article_id].drop(columns="canonical_id", errors="ignore")
 
 # ### Saving processed datasets
-# Now we want to save the processed data and write it to csv files:
-
-behaviors_output_path = dataset_path + "behaviors_processed.csv"
-behaviors_new.to_csv(behaviors_output_path, index=False)
+# Now we want to save the processed news data and write it to a csv file:
 
 news_output_path = dataset_path + "news_processed.csv"
 news_new.to_csv(news_output_path, index=False)
 
+# MIND also comes with **knowledge graph embeddings** for the entities in the titles and abstracts. If they are available, we pool them into one entity vector per article (in the order of `news_processed.csv`). The first time, the .vec text file is converted into a binary matrix which is memory-mapped afterwards:
+
+entity_embedding_path = dataset_path + "entity_embedding.vec"
+if os.path.exists(entity_embedding_path):
+    with stage("entity_features", rows=len(news_new)):
+        entity_matrix, entity_index = load_vec(entity_embedding_path)
+        title_entity_features = pool_entities(news_new.title_entities, entity_matrix, entity_index)
+        abstract_entity_features = pool_entities(news_new.abstract_entities, entity_matrix, entity_index)
+        np.save(dataset_path + "news_entity_features.npy",
+                np.hstack((title_entity_features, abstract_entity_features)))
+
 
 # ### Preprocessing for collaborative filtering approaches
 # For the deployment of recommender systems which use Collaborative Filtering (CF) techniques, user-article interactions play a pivotal role. Because CF is of great importance to understand modern day recommender systems in general, we too want to construct and discuss different versions of this approach. In order to do this, it is useful to further process our data with repsect to user-article interactions. 
@@ -197,135 +161,56 @@ news_new.to_csv(news_output_path, index=False)
 # Because we **only work with the click history** when deploying CF methods, we only need one session per user:
 # 
 
-behaviors_cf = behaviors_new.drop_duplicates(subset='user_id').copy()
-
-assert behaviors_cf.shape[0] == behaviors_new.user_id.nunique(),        "User duplicates have not been dropped"
-
-# Now we want to construct a numpy array out of this smaller dataset
-
-behav_cf = behaviors_cf.to_numpy(copy=True)
-
-# so that we can get **two lists with user-article-interactions**. One for training and another one with the last article in history for testing purposes:
-
-uai_train, uai_test = [], []
-
-for row in behav_cf:
-    user = row[1]
-    hist = row[3].split(' ')
-    for art in hist[:-1]:
-        uai_train.append([user, art])
-    last_art = hist[-1]
-    uai_test.append([user, last_art])
+assert behaviors_cf.shape[0] == behaviors_stats['users_out'],        "User duplicates have not been dropped"
 
-#uai_train, uai_test = [], []
-#i = 0
-#with open(behaviors_output_path, "r") as f:
-#    header = f.readline()
-#    line = f.readline()
-#    print(header)
-#    print(line)
-#    while line != None and line != "":
-#        i += 1
-#        print(i, end="\r")
-#        row = line.split(",")
-#        user = row[1]
-#        hist = row[3].split(' ')
-#        for art in hist[:-1]:
-#            uai_train.append([user, art])
-#            
-#        last_art = hist[-1]
-#        uai_test.append([user, last_art])
-#        line = f.readline()
-
-
-# Now we want to get some **extra user- and article integer IDs**, that we can later use for a **dictionary-of-keys-matrix**, which in turn will be **employed in a neural network**. For our train data, we can do it like this:
-
-uai_train_df = pd.DataFrame(uai_train, columns=['user_id', 'article_id'])
-
-uai_train_df['user_int_id'] = uai_train_df.user_id.astype('category').cat.codes
-uai_train_df['article_int_id'] = uai_train_df.article_id.astype('category').cat.codes
-
-# and for our test data, we need to make sure that it contains only the articles which are also in the train data. At first, we need to find those articles:
-
-train_articles = [elem[1] for elem in uai_train]
-test_articles = [elem[1] for elem in uai_test]
-articles_to_drop = set(test_articles)-set(train_articles)
-
-# With this list, we're now able to reduce our test data:
-
-uai_test_red = [ele for ele in uai_test if ele[1] not in articles_to_drop]
-
-# and can thus create a test dataframe without unknown articles:
-
-uai_test_df = pd.DataFrame(uai_test_red, columns=['user_id', 'article_id'])
-
-# We can then construct two dictionaries, which map the original user and article IDs to the integer IDs:
-
-user_code_dict = pd.Series(uai_train_df.user_int_id.values,
-                           index=uai_train_df.user_id).to_dict()
-
-article_code_dict = pd.Series(uai_train_df.article_int_id.values,
-                              index=uai_train_df.article_id).to_dict()
-
-uai_test_df['user_int_id'] = [user_code_dict[user] for user in uai_test_df.user_id]
-uai_test_df['article_int_id'] = [article_code_dict[art] for art in uai_test_df.article_id]
+# From this smaller dataset we get **two dataframes with user-article-interactions**. One for training and another one with the last article in history for testing purposes. Both get **extra user- and article integer IDs**, that we can later use for an **interaction matrix**, which in turn will be **employed in a neural network**. The test data only contains the articles which are also in the train data:
 
 uai_train_path = dataset_path + f"{dataset_size}_train.csv"
-uai_train_df.to_csv(uai_train_path, index=False)
-
 uai_test_path = dataset_path + f"{dataset_size}_test.csv"
-uai_test_df.to_csv(uai_test_path, index=False)
 
-# Now we actually **create the dok-matrix**:
+def interactions_stage(behaviors_cf):
+    uai_train_df, uai_test_df = user_article_interactions(behaviors_cf)
+    uai_train_df.to_csv(uai_train_path, index=False)
+    uai_test_df.to_csv(uai_test_path, index=False)
+    return uai_train_df, uai_test_df
 
-num_users, num_articles = uai_train_df.user_id.nunique(), uai_train_df.article_id.nunique()
-num_users, num_articles
+uai_train_df, uai_test_df = cache.run("interactions", interactions_stage, behaviors_cf,
+                                      deps=["behaviors"], outputs=[uai_train_path, uai_test_path])
 
-train_matrix = sp.dok_matrix((num_users, num_articles), dtype=np.float32)
+# Now we actually **create the interaction matrix**. Instead of filling a dictionary-of-keys-matrix entry by entry, we build it in one shot from the integer ID columns as a CSR matrix:
 
-with open(uai_train_path, "r") as f:
-    header = f.readline()
-    line = f.readline()
-    print(header)
-    print(line)
-    while line != None and line != "":
-        line_list = line.split(",")
-        user, article = int(line_list[2]), int(line_list[3])
-        train_matrix[user, article] = 1.0
-        line = f.readline()
+num_users, num_articles = uai_train_df.user_id.nunique(), uai_train_df.article_id.nunique()
+num_users, num_articles
 
-if pickle_matrix:
-    pickle.dump(train_matrix, open(dataset_path + "train_matrix.pkl", "wb"))
+train_matrix = cache.run("train_matrix", build_interaction_matrix,
+                         uai_train_df.user_int_id, uai_train_df.article_int_id,
+                         deps=["interactions"], shape=(num_users, num_articles))
 
 # Later on, when we want to evaluate our recommender systems, we need to **compare the ranking for the known -- but not learned -- interactions with known non-interactions**, so that we can tell how useful our recommendation is: the higher the ranking of the test interaction, the better our model! In order to do this, we want to **extract 99 non read articles for every user in our test set**.
-
-test_interactions = list(zip(uai_test_df.user_int_id, uai_test_df.article_int_id))
-
-num_negatives = 99
-
-negative_interactions = []
-for u, i in test_interactions:
-    negatives = []
-    for t in range(num_negatives):
-        j = np.random.randint(num_articles)
-        while (u, j) in train_matrix.keys():
-            j = np.random.randint(num_articles)
-        negatives.append(j)
-    negative_interactions.append(negatives)
-
+#
 # **Finally**, we want to **write our one positive interaction along with the randomly generated non interactions into a tsv file** and we're done with the cleaning and preprocessing of the data!
 
-output = negative_interactions[:]
+test_negatives_path = dataset_path + f"{dataset_size}_test_negatives.tsv"
 
-for i in range(len(test_interactions)):
-    output[i].insert(0, test_interactions[i])
+def test_negatives_stage(train_matrix, uai_test_df, num_negatives, seed):
+    test_users = uai_test_df.user_int_id.to_numpy()
+    test_articles = uai_test_df.article_int_id.to_numpy()
+    negative_interactions = sample_negatives(train_matrix, test_users, num_negatives, seed=seed)
 
-test_negatives_path = dataset_path + f"{dataset_size}_test_negatives.tsv"
-with open(test_negatives_path, 'w') as f:
-    for line in output:
-        line_str = '\t'.join(str(ele) for ele in line) + "\n"
-        f.write(line_str)
+    with open(test_negatives_path, 'w') as f:
+        for u, i, negatives in zip(test_users, test_articles, negative_interactions):
+            line_str = f"({u}, {i})\t" + '\t'.join(map(str, negatives)) + "\n"
+            f.write(line_str)
+    return negative_interactions
+
+num_negatives = 99
 
+negative_interactions = cache.run("test_negatives", test_negatives_stage, train_matrix, uai_test_df,
+                                  deps=["train_matrix", "interactions"], outputs=[test_negatives_path],
+                                  num_negatives=num_negatives, seed=seed)
 
+# Here is an overview of which stages were loaded from the cache and how long every stage took:
 
+cache.report()
 
+profiler.save_report(dataset_path + "profile_report.json")
@@ -0,0 +1,190 @@
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+from profilingHelper import log
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def shingle_hashes(texts, k=3):
+    # word k-shingles of every text as 64 bit hashes, CSR-style: the shingles
+    # of text i are hashes[indptr[i]:indptr[i+1]]. Texts with fewer than k
+    # words are represented by their single words.
+    tokens = texts.fillna('').str.lower().str.findall(r'\w+')
+    lengths = tokens.str.len().to_numpy()
+    flat = np.concatenate(tokens.to_numpy()) if lengths.sum() else np.zeros(0, dtype=str)
+    token_hashes = pd.util.hash_array(flat.astype(object))
+    docs = np.repeat(np.arange(len(texts)), lengths)
+
+    # a shingle starts at every token, which is followed by k-1 tokens of the same text
+    n_starts = max(len(flat) - k + 1, 0)
+    valid = docs[:n_starts] == docs[k-1:k-1+n_starts]
+    shingles = np.zeros(n_starts, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for j in range(k):
+            shingles = shingles * np.uint64(1_000_003) + token_hashes[j:j+n_starts]
+    shingle_docs = docs[:n_starts][valid]
+    shingles = shingles[valid]
+
+    short = np.bincount(shingle_docs, minlength=len(texts)) == 0
+    short_tokens = short[docs]
+    shingle_docs = np.concatenate((shingle_docs, docs[short_tokens]))
+    shingles = np.concatenate((shingles, token_hashes[short_tokens]))
+
+    order = np.argsort(shingle_docs, kind='stable')
+    counts = np.bincount(shingle_docs, minlength=len(texts))
+
+    return np.concatenate(([0], np.cumsum(counts))), shingles[order]
+
+
+def minhash_signatures(indptr, hashes, num_perm=128, random_seed=1, block_size=1 << 24):
+    # MinHash signature of every set of shingle hashes: for every one of the
+    # num_perm hash functions (a * x + b) mod p the minimum over the set. The
+    # minima of all sets are taken at once with np.minimum.reduceat, for as
+    # many hash functions at a time as fit into `block_size` values.
+    # Empty sets get the signature MAX_HASH everywhere.
+    rng = np.random.default_rng(random_seed)
+    a = rng.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, 1 << 31, size=num_perm, dtype=np.uint64)
+    x = hashes & MAX_HASH
+
+    n = len(indptr) - 1
+    signatures = np.full((n, num_perm), MAX_HASH, dtype=np.uint32)
+    non_empty = np.flatnonzero(np.diff(indptr))
+    if len(x) == 0:
+        return signatures
+
+    step = max(block_size // len(x), 1)
+    for start in range(0, num_perm, step):
+        perm = slice(start, start + step)
+        values = ((a[perm, None] * x[None, :] + b[perm, None]) % MERSENNE_PRIME) & MAX_HASH
+        signatures[non_empty, perm] = np.minimum.reduceat(values, indptr[non_empty], axis=1).T
+
+    return signatures
+
+
+def lsh_params(threshold, num_perm):
+    # number of bands and rows per band, such that the S-curve of the banding,
+    # 1 - (1 - s^rows)^bands, rises closest to the Jaccard `threshold`
+    rows = min(range(1, num_perm + 1),
+               key=lambda r: abs((1 / (num_perm // r)) ** (1 / r) - threshold))
+    return num_perm // rows, rows
+
+
+def candidate_pairs(signatures, bands, rows, skip=None):
+    # articles with identical signature rows in at least one band. Every
+    # article in a bucket is paired with the first article of the bucket,
+    # which connects the whole bucket with a linear number of pairs.
+    # Articles flagged in `skip` (e.g. without any shingles) are left out.
+    keep = np.flatnonzero(~skip) if skip is not None else np.arange(len(signatures))
+    multipliers = np.random.default_rng(0).integers(1, 1 << 63, size=rows, dtype=np.uint64) | np.uint64(1)
+
+    left, right = [], []
+    for band in range(bands):
+        block = signatures[keep, band*rows:(band+1)*rows].astype(np.uint64)
+        with np.errstate(over='ignore'):
+            keys = (block * multipliers).sum(axis=1)
+        buckets, _ = pd.factorize(keys)
+        order = np.argsort(buckets, kind='stable')
+        sorted_buckets = buckets[order]
+        starts = np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]]
+        leaders = order[np.flatnonzero(starts)][np.cumsum(starts) - 1]
+        members = leaders != order
+        left.append(keep[leaders[members]])
+        right.append(keep[order[members]])
+
+    left, right = np.concatenate(left), np.concatenate(right)
+    pairs = np.unique(np.column_stack((left, right)), axis=0) if len(left) else np.zeros((0, 2), dtype=np.int64)
+
+    return pairs[:, 0], pairs[:, 1]
+
+
+def article_signatures(news, num_perm=128, k=3, random_seed=1):
+    # MinHash signatures of the title + abstract shingles of every article
+    texts = news.title.fillna('') + ' ' + news.abstract.fillna('')
+    indptr, hashes = shingle_hashes(texts.reset_index(drop=True), k=k)
+
+    return minhash_signatures(indptr, hashes, num_perm=num_perm, random_seed=random_seed)
+
+
+def verified_pairs(signatures, threshold):
+    # LSH candidate pairs, whose signatures agree in at least `threshold` of
+    # the positions (the estimated Jaccard similarity). Articles without
+    # any shingles (signature MAX_HASH everywhere) are never paired.
+    bands, rows = lsh_params(threshold, signatures.shape[1])
+    left, right = candidate_pairs(signatures, bands, rows, skip=(signatures == MAX_HASH).all(axis=1))
+    verified = (signatures[left] == signatures[right]).mean(axis=1) >= threshold
+
+    return left[verified], right[verified], len(left)
+
+
+def title_pairs(title_codes):
+    # every article paired with the first article with the same title, as
+    # in canonical_article_ids (negative codes: no title, never merged)
+    with_title = np.flatnonzero(title_codes >= 0)
+    first_of_title = np.full(title_codes.max() + 1 if len(with_title) else 0, len(title_codes))
+    np.minimum.at(first_of_title, title_codes[with_title], with_title)
+    left = first_of_title[title_codes[with_title]]
+    duplicate = left != with_title
+
+    return left[duplicate], with_title[duplicate]
+
+
+def near_duplicate_clusters(news, threshold=0.8, num_perm=128, k=3, random_seed=1, signatures=None):
+    # clusters of articles, whose title + abstract shingles have an (estimated)
+    # Jaccard similarity of at least `threshold`, or which have exactly the
+    # same title. The LSH candidates are verified with the signatures, and
+    # the clusters are the connected components of the verified pairs.
+    # Returns the cluster label of every article and some statistics.
+    start = time.perf_counter()
+    if signatures is None:
+        signatures = article_signatures(news, num_perm=num_perm, k=k, random_seed=random_seed)
+    left, right, n_candidates = verified_pairs(signatures, threshold)
+    title_left, title_right = title_pairs(pd.factorize(news.title)[0])
+
+    n = len(news)
+    edges_left = np.concatenate((left, title_left))
+    edges_right = np.concatenate((right, title_right))
+    graph = sp.csr_matrix((np.ones(len(edges_left)), (edges_left, edges_right)), shape=(n, n))
+    n_clusters, labels = connected_components(graph, directed=False)
+
+    sizes = np.bincount(labels)
+    bands, rows = lsh_params(threshold, num_perm)
+    stats = {'articles': n,
+             'candidate_pairs': n_candidates,
+             'verified_pairs': len(left),
+             'duplicate_clusters': int((sizes > 1).sum()),
+             'redundant_articles': int(n - n_clusters),
+             'exact_title_redundant': len(title_right),
+             'bands': bands, 'rows': rows,
+             'seconds': time.perf_counter() - start}
+    log(f"Near-duplicates: {stats['duplicate_clusters']} clusters, {stats['redundant_articles']} redundant",
+        f"articles ({stats['exact_title_redundant']} with identical titles), {stats['candidate_pairs']}",
+        f"LSH candidates, {stats['seconds']:.2f}s")
+
+    return labels, stats
+
+
+def add_near_duplicate_ids(news, threshold=0.8, num_perm=128, k=3, random_seed=1,
+                           return_signatures=False):
+    # adds the column 'canonical_id' (the first article of every near
+    # duplicate cluster), which canonical_article_ids uses instead of the
+    # exact title matching. With `return_signatures` the MinHash signatures
+    # are returned as well, so they can be stored with the article table
+    # for the deduplication of articles added later (see ingestionHelper.py).
+    signatures = article_signatures(news, num_perm=num_perm, k=k, random_seed=random_seed)
+    labels, stats = near_duplicate_clusters(news, threshold=threshold, num_perm=num_perm,
+                                            signatures=signatures)
+    first = np.full(labels.max() + 1 if len(labels) else 0, len(labels))
+    np.minimum.at(first, labels, np.arange(len(labels)))
+
+    news = news.copy()
+    news['canonical_id'] = news.article_id.to_numpy()[first[labels]]
+    if return_signatures:
+        return news, signatures
+
+    return news
@@ -0,0 +1,66 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+WIKIDATA_ID_PATTERN = r'"WikidataId":\s*"([^"]+)"'
+
+
+def binary_paths(path_to_file):
+    base = os.path.splitext(path_to_file)[0]
+    return base + ".npy", base + "_ids.npy"
+
+
+def convert_vec(path_to_file):
+    # parses a MIND entity_embedding.vec / relation_embedding.vec text file
+    # (WikidataId followed by tab separated values) once and stores it as a
+    # float32 matrix plus an array with the WikidataId of every row
+    vec = pd.read_csv(path_to_file, sep='\t', header=None, quoting=3, dtype={0: str})
+    vec = vec.dropna(axis=1, how='all')
+    ids = vec.iloc[:, 0].to_numpy().astype(str)
+    matrix = np.ascontiguousarray(vec.iloc[:, 1:].to_numpy(dtype=np.float32))
+
+    matrix_path, ids_path = binary_paths(path_to_file)
+    np.save(matrix_path, matrix)
+    np.save(ids_path, ids)
+
+    return matrix, ids
+
+
+def load_vec(path_to_file, mmap_mode='r'):
+    # memory-maps the binary version of a .vec file, which is (re)created if
+    # it is missing or older than the .vec file. Returns the embedding matrix
+    # and a pd.Index, which maps WikidataIds to rows.
+    matrix_path, ids_path = binary_paths(path_to_file)
+    up_to_date = os.path.exists(matrix_path) and os.path.exists(ids_path) \
+        and os.path.getmtime(matrix_path) >= os.path.getmtime(path_to_file)
+    if not up_to_date:
+        convert_vec(path_to_file)
+
+    matrix = np.load(matrix_path, mmap_mode=mmap_mode)
+    ids = np.load(ids_path)
+
+    return matrix, pd.Index(ids)
+
+
+def pool_entities(entity_column, matrix, id_index):
+    # mean of the embeddings of all (known) entities in the title_entities or
+    # abstract_entities JSON strings of every article. The WikidataIds are
+    # extracted with one vectorized regex instead of parsing the JSON, and
+    # pooling is a single sparse (articles x entities) matrix product.
+    # Articles without known entities get a zero vector.
+    found = entity_column.fillna('').str.findall(WIKIDATA_ID_PATTERN)
+    lengths = found.str.len().to_numpy()
+    flat = np.concatenate(found.to_numpy()) if lengths.sum() else np.zeros(0, dtype=str)
+
+    rows = np.repeat(np.arange(len(found)), lengths)
+    cols = id_index.get_indexer(flat)
+    known = cols >= 0
+    rows, cols = rows[known], cols[known]
+
+    counts = np.bincount(rows, minlength=len(found))
+    weights = 1 / counts[rows]
+    pooling = sp.csr_matrix((weights.astype(np.float32), (rows, cols)),
+                            shape=(len(found), len(id_index)))
+
+    return np.asarray(pooling @ matrix, dtype=np.float32)
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+from preprocessingHelper import (import_news, read_behaviors_chunks, clean_behaviors_chunk, title_hashes,
+                                 append_article_table, load_article_table, load_near_duplicate_state,
+                                 BehaviorsArrayWriter)
+from dedupHelper import article_signatures, title_pairs, verified_pairs
+from cacheHelper import file_hash
+from profilingHelper import log, stage
+
+
+def extend_article_table(path, news):
+    # adds the articles of `news`, which are not in the stored vocabulary yet,
+    # to the end of it, so the codes of all known articles stay the same.
+    # The new articles are deduplicated with the settings of the stored build:
+    # they are linked to (known or new) articles with the same title (compared
+    # by title hashes) and, if the build merged near duplicates, to the ones
+    # with similar MinHash signatures (see dedupHelper.py). Every new article
+    # gets the smallest canonical code among the articles it is linked to
+    # (directly or through other new articles), like the first article of a
+    # cluster in a full run. Clusters of known articles, which a new article
+    # links, are not merged, as that would rewrite their codes. The new
+    # articles are appended to the stored table. Returns the article index
+    # and canonical codes.
+    article_index, canonical_codes, hashes = load_article_table(path)
+    near_duplicates, signatures = load_near_duplicate_state(path)
+
+    new = news.drop_duplicates(subset='article_id')
+    new = new[~new.article_id.isin(article_index)]
+    if len(new) == 0:
+        return article_index, canonical_codes
+
+    n_known = len(article_index)
+    n = n_known + len(new)
+    new_hashes = title_hashes(new.title)
+
+    # articles without a title (hash 0) are never merged by their title
+    all_hashes = np.concatenate((hashes, new_hashes))
+    title_codes = pd.factorize(all_hashes)[0]
+    title_codes[all_hashes == 0] = -1
+    left, right = title_pairs(title_codes)
+
+    new_signatures = None
+    if near_duplicates is not None:
+        settings = dict(near_duplicates)
+        threshold = settings.pop('threshold')
+        new_signatures = article_signatures(new, **settings)
+        similar_left, similar_right, _ = verified_pairs(np.vstack((signatures, new_signatures)), threshold)
+        left = np.concatenate((left, similar_left))
+        right = np.concatenate((right, similar_right))
+
+    # the links of new articles, plus every known article to its canonical one
+    new_links = np.maximum(left, right) >= n_known
+    edges_left = np.concatenate((left[new_links], np.arange(n_known)))
+    edges_right = np.concatenate((right[new_links], canonical_codes))
+    graph = sp.csr_matrix((np.ones(len(edges_left)), (edges_left, edges_right)), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    smallest = np.full(labels.max() + 1, n)
+    np.minimum.at(smallest, labels, np.arange(n))
+    new_canonical = smallest[labels[n_known:]]
+
+    new_ids = new.article_id.to_numpy().astype(str)
+    append_article_table(path, new_ids, new_canonical, new.title, signatures=new_signatures)
+    article_index = article_index.append(pd.Index(new_ids))
+    canonical_codes = np.concatenate((canonical_codes, new_canonical)).astype(np.int32)
+
+    return article_index, canonical_codes
+
+
+def ingest_day(behaviors_path, news_path, arrays_path, min_history=5, chunksize=100_000):
+    # appends one day of MIND-style logs to the integer encoded arrays written
+    # by data_preprocessing.py (behaviors_processed_arrays/). The article and
+    # user vocabularies are only extended, the new sessions are cleaned like
+    # in stream_behaviors and appended to the arrays, and their reads are
+    # appended to the interaction arrays. Nothing stored is rewritten, only
+    # the vocabularies are read to look up the codes of known users and
+    # articles. A behaviors file, which was ingested before, is refused.
+    assert os.path.exists(os.path.join(arrays_path, 'article_canonical.npy')), \
+        f"no encoded arrays to append to in {arrays_path}, run data_preprocessing.py first"
+
+    log_path = os.path.join(arrays_path, 'ingested.json')
+    ingested = []
+    if os.path.exists(log_path):
+        with open(log_path) as f:
+            ingested = json.load(f)
+    behaviors_hash = file_hash(behaviors_path)
+    assert behaviors_hash not in [day['hash'] for day in ingested], \
+        f"{behaviors_path} has already been ingested"
+
+    with stage("ingest_day") as record:
+        n_articles = len(np.load(os.path.join(arrays_path, 'article_vocab.npy'), mmap_mode='r'))
+        article_index, canonical_codes = extend_article_table(arrays_path, import_news(news_path))
+
+        writer = BehaviorsArrayWriter(arrays_path, article_index, append=True)
+        n_users = len(writer.user2idx)
+        stats = {'file': os.path.abspath(behaviors_path), 'hash': behaviors_hash,
+                 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 'sessions_in': 0, 'sessions_out': 0}
+        for chunk in read_behaviors_chunks(behaviors_path, chunksize=chunksize):
+            cleaned, codes = clean_behaviors_chunk(chunk, article_index, canonical_codes,
+                                                   min_history=min_history, return_codes=True)
+            writer.append(cleaned, codes)
+            stats['sessions_in'] += len(chunk)
+            stats['sessions_out'] += len(cleaned)
+        matrix = writer.close()
+        record.rows = stats['sessions_in']
+
+    stats.update(new_articles=len(article_index) - n_articles,
+                 new_users=len(writer.user2idx) - n_users,
+                 new_interactions=int(matrix.nnz))
+    ingested.append(stats)
+    with open(log_path, 'w') as f:
+        json.dump(ingested, f, indent=1)
+
+    log(f"Ingested {stats['sessions_out']} of {stats['sessions_in']} sessions,",
+        f"{stats['new_users']} new users and {stats['new_articles']} new articles.")
+
+    return stats
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+def build_interaction_matrix(users, articles, shape=None, dtype=np.float32):
+    # builds the binary user-article matrix in one shot (COO -> CSR) from the
+    # integer ID columns. Repeated interactions are stored only once and the
+    # column indices of every row are sorted, which has_interaction relies on.
+    users = np.asarray(users, dtype=np.int32)
+    articles = np.asarray(articles, dtype=np.int32)
+    if shape is None:
+        shape = (int(users.max()) + 1 if len(users) else 0,
+                 int(articles.max()) + 1 if len(articles) else 0)
+
+    data = np.ones(len(users), dtype=dtype)
+    matrix = sp.coo_matrix((data, (users, articles)), shape=shape).tocsr()
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+
+    return matrix
+
+
+def load_interaction_matrix(path_to_file, shape=None, columns=(2, 3), dtype=np.float32):
+    # `columns` are the positions of the integer user and article ID columns
+    # in the {size}_train.csv files
+    ids = pd.read_csv(path_to_file, usecols=list(columns), dtype=np.int32)
+    user_col, article_col = (ids.columns[sorted(columns).index(c)] for c in columns)
+
+    return build_interaction_matrix(ids[user_col].to_numpy(), ids[article_col].to_numpy(),
+                                    shape=shape, dtype=dtype)
+
+
+def has_interaction(matrix, u, items):
+    # vectorized membership test: is (u, item) stored in the CSR `matrix`?
+    # `u` is a user ID or an array of user IDs broadcastable against `items`.
+    # Every pair is looked up by a binary search within the sorted CSR row, all
+    # pairs at once, so this costs O(len(items) * log(row length)).
+    items = np.asarray(items)
+    u = np.broadcast_to(np.asarray(u), items.shape)
+    if matrix.nnz == 0:
+        return np.zeros(items.shape, dtype=bool)
+
+    indices = matrix.indices
+    last = len(indices) - 1
+    lo = matrix.indptr[u].astype(np.int64)
+    hi = matrix.indptr[u + 1].astype(np.int64)
+    row_end = hi.copy()
+
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        go_right = active & (indices[np.minimum(mid, last)] < items)
+        lo = np.where(go_right, mid + 1, lo)
+        hi = np.where(active & ~go_right, mid, hi)
+        active = lo < hi
+
+    return (lo < row_end) & (indices[np.minimum(lo, last)] == items)
+
@@ -0,0 +1,562 @@
+import io
+import os
+import json
+import time
+import itertools
+import numpy as np
+import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from interactionHelper import build_interaction_matrix
+from dedupHelper import article_signatures
+from profilingHelper import log
+
+BEHAVIORS_COLUMNS = ['impression_id', 'user_id', 'time', 'history', 'impressions']
+NEWS_COLUMNS = ['article_id', 'category', 'subcategory', 'title',
+                'abstract', 'url', 'title_entities', 'abstract_entities']
+
+
+def import_news(path_to_file):
+    return pd.read_csv(path_to_file, sep='\t', header=None, names=NEWS_COLUMNS)
+
+
+def read_behaviors_chunks(path_to_file, chunksize=100_000):
+    # the raw behaviors.tsv is never held in memory as a whole, only one chunk
+    # of `chunksize` sessions at a time
+    return pd.read_csv(path_to_file, sep='\t', header=None,
+                       names=BEHAVIORS_COLUMNS, chunksize=chunksize)
+
+
+def canonical_article_ids(news):
+    # every article is mapped to the first article ID with the same title, or
+    # to the one in the 'canonical_id' column, if the near duplicates have
+    # been detected (see dedupHelper.add_near_duplicate_ids)
+    if 'canonical_id' in news:
+        return news.canonical_id
+    canonical = news.groupby('title', sort=False).article_id.transform('first')
+    return canonical.fillna(news.article_id)
+
+
+def duplicate_article_dict(news):
+    canonical = canonical_article_ids(news)
+    redundant = canonical != news.article_id
+
+    return dict(zip(news.article_id[redundant], canonical[redundant]))
+
+
+def article_remap_table(news):
+    # interns the article IDs of the news dataset to integer codes together
+    # with a lookup array, which maps every code to its canonical code
+    news = news.drop_duplicates(subset='article_id')
+    article_index = pd.Index(news.article_id)
+    canonical_codes = article_index.get_indexer(canonical_article_ids(news)).astype(np.int32)
+
+    return article_index, canonical_codes
+
+
+def title_hashes(titles):
+    # 64 bit hashes of the titles, 0 for articles without a title (which are
+    # never merged). Unlike the titles they have a fixed width, so the table
+    # can be appended to in place.
+    titles = pd.Series(titles).fillna('').astype(str).to_numpy(dtype=object)
+    hashes = pd.util.hash_array(titles)
+    hashes[titles == ''] = 0
+
+    return hashes
+
+
+def save_article_table(path, article_index, canonical_codes, titles, near_duplicates=None,
+                       signatures=None):
+    # the article vocabulary (codes are positions in it), the canonical code
+    # of every article and the title hashes, which the deduplication of
+    # articles added later on (see ingestionHelper.py) is based on. With
+    # `near_duplicates` (the settings of dedupHelper.add_near_duplicate_ids)
+    # these settings and the MinHash signatures of the articles are stored,
+    # too, so that the new articles are deduplicated in the same way.
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'article_vocab.npy'), article_index.to_numpy().astype(str))
+    np.save(os.path.join(path, 'article_canonical.npy'), np.asarray(canonical_codes, dtype=np.int32))
+    np.save(os.path.join(path, 'article_title_hashes.npy'), title_hashes(titles))
+    with open(os.path.join(path, 'article_dedup.json'), 'w') as f:
+        json.dump(near_duplicates, f)
+    if near_duplicates is not None:
+        # flattened, so that it can be appended to with append_npy
+        np.save(os.path.join(path, 'article_minhash.npy'), np.asarray(signatures, dtype=np.uint32).ravel())
+
+
+def append_article_table(path, article_ids, canonical_codes, titles, signatures=None):
+    # appends new articles to the stored table, nothing old is rewritten
+    append_npy(os.path.join(path, 'article_vocab.npy'), np.asarray(article_ids).astype(str))
+    append_npy(os.path.join(path, 'article_canonical.npy'), np.asarray(canonical_codes, dtype=np.int32))
+    append_npy(os.path.join(path, 'article_title_hashes.npy'), title_hashes(titles))
+    if signatures is not None:
+        append_npy(os.path.join(path, 'article_minhash.npy'), np.asarray(signatures, dtype=np.uint32).ravel())
+
+
+def load_article_table(path):
+    article_index = pd.Index(np.load(os.path.join(path, 'article_vocab.npy')))
+    canonical_codes = np.load(os.path.join(path, 'article_canonical.npy'))
+    hashes = np.load(os.path.join(path, 'article_title_hashes.npy'))
+
+    return article_index, canonical_codes, hashes
+
+
+def load_near_duplicate_state(path):
+    # the near duplicate settings of the stored table (None: identical titles
+    # only) and the MinHash signatures of its articles
+    settings_path = os.path.join(path, 'article_dedup.json')
+    assert os.path.exists(settings_path), \
+        f"no deduplication settings stored in {path}, run data_preprocessing.py again"
+    with open(settings_path) as f:
+        near_duplicates = json.load(f)
+    if near_duplicates is None:
+        return None, None
+    signatures = np.load(os.path.join(path, 'article_minhash.npy'))
+
+    return near_duplicates, signatures.reshape(-1, near_duplicates['num_perm'])
+
+
+def split_tokens(strings, labelled=False):
+    # all tokens of all rows with a single split of the joined strings. The
+    # number of tokens per row is counted from the single spaces, which is
+    # checked against the split (rows with other whitespace are split again
+    # one by one). Impressions are split at the "-" of their labels as well.
+    strings = strings.to_numpy(dtype=object)
+    joined = ' '.join(strings)
+    lengths = np.fromiter((row.count(' ') + 1 if row else 0 for row in strings),
+                          dtype=np.int64, count=len(strings))
+
+    if labelled:
+        parts = np.array(joined.replace('-', ' ').split(), dtype=object)
+        if len(parts) == 2 * lengths.sum():
+            return parts[0::2], parts[1::2], lengths
+        # IDs with a "-" of their own, or other whitespace
+        flat = pd.Series(joined.split(), dtype=object)
+        lengths = np.fromiter((len(row.split()) for row in strings), dtype=np.int64, count=len(strings))
+        return flat.str[:-2].to_numpy(dtype=object), flat.str[-1:].to_numpy(dtype=object), lengths
+
+    flat = np.array(joined.split(), dtype=object)
+    if len(flat) != lengths.sum():
+        lengths = np.fromiter((len(row.split()) for row in strings), dtype=np.int64, count=len(strings))
+
+    return flat, None, lengths
+
+
+def join_tokens(names, tokens, lengths, labels=None, label_names=None):
+    # inverse of split_tokens: the space separated string of every row, whose
+    # tokens are given as positions in `names` (and in `label_names` for the
+    # "-<label>" suffixes). Every name is prepared once with each suffix, so
+    # all rows are built with a single join (separated by newlines, which
+    # article IDs don't contain).
+    suffixes = [' ', '\n']
+    if labels is not None:
+        suffixes = ['-' + label + sep for label in label_names for sep in (' ', '\n')]
+    table = np.array([names + suffix for suffix in suffixes], dtype=object)
+
+    last = np.zeros(len(tokens), dtype=np.int64)
+    last[np.cumsum(lengths)[lengths > 0] - 1] = 1
+    variant = last if labels is None else 2 * labels + last
+    rows = ''.join(table[variant, tokens].tolist()).split('\n')[:-1]
+
+    strings = np.full(len(lengths), '', dtype=object)
+    strings[lengths > 0] = rows
+
+    return strings
+
+
+def remap_articles(strings, article_index, canonical_codes, labelled=False):
+    # token level remapping of space separated article IDs (impressions when
+    # `labelled`, i.e. with click labels "-0"/"-1"). Returns the remapped
+    # strings, the article codes per token (-1 for articles unknown to the
+    # news dataset), the click labels per token (None if not `labelled`), the
+    # number of tokens per row and an "unknown article" flag per row.
+    # Only the distinct IDs of the chunk are looked up.
+    ids, labels, lengths = split_tokens(strings, labelled=labelled)
+    rows = np.repeat(np.arange(len(strings)), lengths)
+
+    tokens, unique_ids = pd.factorize(ids)
+    unique_codes = article_index.get_indexer(unique_ids)
+    unique_unknown = unique_codes < 0
+    unique_remapped = np.where(unique_unknown, unique_codes, canonical_codes[unique_codes])
+
+    codes = unique_codes[tokens]
+    remapped = unique_remapped[tokens]
+    has_unknown = np.bincount(rows, weights=unique_unknown[tokens], minlength=len(strings)) > 0
+
+    # only the rows which actually contain a redundant ID are rebuilt, all
+    # of them at once (unknown articles keep their ID)
+    changed = remapped != codes
+    changed_rows = np.bincount(rows, weights=changed, minlength=len(strings)) > 0
+    strings = strings.to_numpy(dtype=object, copy=True)
+    if changed_rows.any():
+        in_changed = changed_rows[rows]
+        names = np.where(unique_unknown, unique_ids,
+                         article_index.to_numpy(dtype=object)[unique_remapped])
+        label_codes = label_names = None
+        if labelled:
+            label_codes, label_names = pd.factorize(labels[in_changed])
+        strings[changed_rows] = join_tokens(names, tokens[in_changed], lengths[changed_rows],
+                                            labels=label_codes, label_names=label_names)
+
+    if labelled:
+        labels = (labels == '1').astype(np.int8)
+
+    return strings, remapped.astype(np.int32), labels, lengths, has_unknown
+
+
+def clean_behaviors_chunk(chunk, article_index, canonical_codes, min_history=5,
+                          return_codes=False):
+    chunk = chunk.dropna().copy()
+
+    chunk['length_history'] = chunk.history.str.split().map(len)
+    chunk = chunk[chunk['length_history'] >= min_history]
+
+    chunk['history'], hist_codes, _, hist_lengths, hist_unknown = remap_articles(
+        chunk.history, article_index, canonical_codes)
+    chunk['impressions'], impr_codes, impr_labels, impr_lengths, impr_unknown = remap_articles(
+        chunk.impressions, article_index, canonical_codes, labelled=True)
+
+    keep = ~(hist_unknown | impr_unknown)
+    if not return_codes:
+        return chunk[keep]
+
+    hist_keep = np.repeat(keep, hist_lengths)
+    impr_keep = np.repeat(keep, impr_lengths)
+    codes = {'history': hist_codes[hist_keep],
+             'history_lengths': hist_lengths[keep],
+             'impressions': impr_codes[impr_keep],
+             'impressions_lengths': impr_lengths[keep],
+             'labels': impr_labels[impr_keep]}
+
+    return chunk[keep], codes
+
+
+# ## Integer encoded on-disk format for the processed behaviors
+# Every array is stored as a separate .npy file in one directory, so that all
+# of them can be memory-mapped with np.load(mmap_mode='r'). Histories and
+# impressions are stored CSR-style: the articles of session i are
+# indices[indptr[i]:indptr[i+1]].
+
+ARRAY_DTYPES = {'impression_id': np.int64,
+                'user': np.int32,
+                'time': np.int64,
+                'history_indptr': np.int64,
+                'history_indices': np.int32,
+                'impressions_indptr': np.int64,
+                'impressions_indices': np.int32,
+                'impressions_labels': np.int8}
+
+TIME_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+
+def append_npy(path_to_file, values):
+    # appends `values` to the 1-d array in a .npy file in place. Only the
+    # header is rewritten, numpy pads it so that the shape can grow; if the
+    # new header does not fit anyway, or if `values` are longer strings than
+    # the stored ones, the file is rewritten.
+    with open(path_to_file, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        data_offset = f.tell()
+    values = np.asarray(values)
+    if values.dtype.kind == dtype.kind == 'U' and values.itemsize > dtype.itemsize:
+        np.save(path_to_file, np.concatenate((np.load(path_to_file), values)))
+        return
+    values = values.astype(dtype)
+
+    write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) \
+        else np.lib.format.write_array_header_2_0
+    header = io.BytesIO()
+    write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                          'shape': (shape[0] + len(values),)})
+
+    if len(header.getvalue()) == data_offset:
+        with open(path_to_file, 'r+b') as f:
+            f.seek(0, 2)
+            values.tofile(f)
+            f.seek(0)
+            f.write(header.getvalue())
+    else:
+        old = np.load(path_to_file, mmap_mode='r')
+        data = np.concatenate((old, values))
+        del old
+        np.save(path_to_file, data)
+
+
+class BehaviorsArrayWriter:
+    # appends encoded chunks to flat binary files and converts them to .npy
+    # files on close(), so the arrays never have to be held in memory. With
+    # append=True the chunks are appended to the arrays in `output_dir`
+    # instead: user codes continue the stored user vocabulary, new users are
+    # appended to it, and the (user, article) reads of the new chunks are
+    # appended to the COO arrays of the interaction matrix, which
+    # load_behaviors_arrays combines. So the stored data is never rewritten.
+    copy_blocksize = 1 << 24
+
+    def __init__(self, output_dir, article_index, append=False):
+        self.output_dir = output_dir
+        self.article_index = article_index
+        self.append_mode = append
+        self.user2idx = {}
+        self.n_known_users = 0
+        self.offsets = {'history': 0, 'impressions': 0}
+        self.n_sessions = 0
+        self.interactions = []
+
+        if append:
+            users = np.load(os.path.join(output_dir, 'user_vocab.npy'))
+            self.user2idx = {u: i for i, u in enumerate(users)}
+            self.n_known_users = len(users)
+            for name in self.offsets:
+                indptr = np.load(self._npy_path(name + '_indptr'), mmap_mode='r')
+                self.offsets[name] = int(indptr[-1])
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.files = {name: open(self._raw_path(name), 'wb') for name in ARRAY_DTYPES}
+        if not append:
+            for name in ('history_indptr', 'impressions_indptr'):
+                np.zeros(1, dtype=ARRAY_DTYPES[name]).tofile(self.files[name])
+
+    def _raw_path(self, name):
+        return os.path.join(self.output_dir, name + '.bin')
+
+    def _npy_path(self, name):
+        return os.path.join(self.output_dir, name + '.npy')
+
+    def _write(self, name, values):
+        np.asarray(values, dtype=ARRAY_DTYPES[name]).tofile(self.files[name])
+
+    def append(self, chunk, codes):
+        users = np.array([self.user2idx.setdefault(u, len(self.user2idx)) for u in chunk.user_id],
+                         dtype=np.int64)
+        times = pd.to_datetime(chunk.time, format=TIME_FORMAT).to_numpy(dtype='datetime64[s]')
+
+        self._write('impression_id', chunk.impression_id.to_numpy())
+        self._write('user', users)
+        self._write('time', times.astype(np.int64))
+        for name in ('history', 'impressions'):
+            lengths = codes[name + '_lengths']
+            self._write(name + '_indptr', self.offsets[name] + np.cumsum(lengths))
+            self._write(name + '_indices', codes[name])
+            self.offsets[name] += int(lengths.sum())
+        self._write('impressions_labels', codes['labels'])
+        self.n_sessions += len(chunk)
+
+        # reads of the chunk (history and clicked articles) as unique
+        # user * articles + article keys
+        clicked = codes['labels'] == 1
+        keys = np.concatenate((
+            np.repeat(users, codes['history_lengths']) * len(self.article_index) + codes['history'],
+            np.repeat(users, codes['impressions_lengths'])[clicked] * len(self.article_index)
+            + codes['impressions'][clicked]))
+        self.interactions.append(np.unique(keys))
+
+    def _close_array(self, name, dtype):
+        raw_path = self._raw_path(name)
+        n = os.path.getsize(raw_path) // np.dtype(dtype).itemsize
+        if self.append_mode:
+            if n:
+                raw = np.memmap(raw_path, dtype=dtype, mode='r')
+                append_npy(self._npy_path(name), raw)
+                del raw
+        else:
+            out = np.lib.format.open_memmap(self._npy_path(name), mode='w+', dtype=dtype, shape=(n,))
+            if n:
+                raw = np.memmap(raw_path, dtype=dtype, mode='r')
+                for start in range(0, n, self.copy_blocksize):
+                    out[start:start+self.copy_blocksize] = raw[start:start+self.copy_blocksize]
+                del raw
+            out.flush()
+            del out
+        os.remove(raw_path)
+
+    def _save(self, name, values):
+        if self.append_mode:
+            append_npy(self._npy_path(name), values)
+        else:
+            np.save(self._npy_path(name), values)
+
+    def close(self):
+        # returns the binary user x article matrix of the reads written by
+        # this writer (in the persistent codes)
+        for f in self.files.values():
+            f.close()
+        for name, dtype in ARRAY_DTYPES.items():
+            self._close_array(name, dtype)
+
+        new_users = list(itertools.islice(self.user2idx, self.n_known_users, None))
+        self._save('user_vocab', np.array(new_users, dtype=str))
+
+        keys = np.unique(np.concatenate(self.interactions)) if self.interactions else np.zeros(0, np.int64)
+        users, articles = keys // len(self.article_index), keys % len(self.article_index)
+        self._save('interactions_users', users.astype(np.int32))
+        self._save('interactions_articles', articles.astype(np.int32))
+
+        return build_interaction_matrix(users, articles, shape=(len(self.user2idx), len(self.article_index)))
+
+
+def load_behaviors_arrays(path, mmap_mode='r'):
+    arrays = {}
+    for name in list(ARRAY_DTYPES) + ['user_vocab', 'article_vocab']:
+        arrays[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+    # the reads are stored as append-only COO arrays (with repeated reads
+    # of later days), the matrix is built from all of them
+    users_path = os.path.join(path, 'interactions_users.npy')
+    if os.path.exists(users_path):
+        arrays['interactions'] = build_interaction_matrix(
+            np.load(users_path, mmap_mode=mmap_mode),
+            np.load(os.path.join(path, 'interactions_articles.npy'), mmap_mode=mmap_mode),
+            shape=(len(arrays['user_vocab']), len(arrays['article_vocab'])))
+
+    return arrays
+
+
+def session_articles(arrays, name, i):
+    # articles of the `name` ('history' or 'impressions') column of session i
+    indptr = arrays[name + '_indptr']
+    return arrays[name + '_indices'][indptr[i]:indptr[i+1]]
+
+
+# the remap table is sent to every worker process once and kept there as a
+# read-only global, instead of being pickled with every shard
+_worker_remap_table = None
+
+
+def _init_clean_worker(article_index, canonical_codes):
+    global _worker_remap_table
+    _worker_remap_table = (article_index, canonical_codes)
+
+
+def _clean_shard(chunk, min_history, return_codes, remap_table=None):
+    start = time.perf_counter()
+    article_index, canonical_codes = remap_table or _worker_remap_table
+    cleaned = clean_behaviors_chunk(chunk, article_index, canonical_codes,
+                                    min_history=min_history, return_codes=return_codes)
+    if not return_codes:
+        cleaned = (cleaned, None)
+
+    return len(chunk), cleaned[0], cleaned[1], time.perf_counter() - start
+
+
+def clean_behaviors_shards(behaviors_path, article_index, canonical_codes, min_history=5,
+                           chunksize=100_000, return_codes=False, workers=1):
+    # yields (sessions read, cleaned shard, codes, seconds) for every row range
+    # of `chunksize` sessions, in the order of the file. With workers > 1 the
+    # shards are cleaned in a process pool; at most 2*workers shards are in
+    # flight at once, so memory stays bounded by the chunksize.
+    chunks = read_behaviors_chunks(behaviors_path, chunksize=chunksize)
+    if workers <= 1:
+        for chunk in chunks:
+            yield _clean_shard(chunk, min_history, return_codes,
+                               remap_table=(article_index, canonical_codes))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_clean_worker,
+                             initargs=(article_index, canonical_codes)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_clean_shard, chunk, min_history, return_codes))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def stream_behaviors(behaviors_path, output_path, news, min_history=5, chunksize=100_000,
+                     arrays_path=None, workers=1, near_duplicates=None, signatures=None):
+    # cleans behaviors.tsv chunk by chunk and appends every cleaned chunk to
+    # `output_path`, so peak memory is bounded by `chunksize` and not by the
+    # size of the file. Only the first session of every user is kept in
+    # memory, which is all the collaborative filtering preprocessing needs.
+    # If `arrays_path` is given, the integer encoded format is written, too.
+    # With workers > 1 the chunks are cleaned in parallel, the output is the
+    # same as for the serial run. `near_duplicates` are the settings of
+    # dedupHelper.add_near_duplicate_ids, with which `news` was deduplicated,
+    # and `signatures` the MinHash signatures it returned (computed if missing);
+    # both are stored with the arrays for the ingestion of later days.
+    article_index, canonical_codes = article_remap_table(news)
+    writer = None
+    if arrays_path:
+        first = ~news.article_id.duplicated().to_numpy()
+        if near_duplicates is not None:
+            near_duplicates = {'num_perm': 128, 'k': 3, 'random_seed': 1, **near_duplicates}
+            if signatures is None:
+                signatures = article_signatures(news[first], num_perm=near_duplicates['num_perm'],
+                                                k=near_duplicates['k'],
+                                                random_seed=near_duplicates['random_seed'])
+            else:
+                signatures = signatures[first]
+        save_article_table(arrays_path, article_index, canonical_codes, news.title[first].fillna(''),
+                           near_duplicates=near_duplicates, signatures=signatures)
+        writer = BehaviorsArrayWriter(arrays_path, article_index)
+
+    stats = {'sessions_in': 0, 'sessions_out': 0, 'chunks': 0, 'shards': []}
+    seen_users = set()
+    first_sessions = []
+
+    header = True
+    shards = clean_behaviors_shards(behaviors_path, article_index, canonical_codes,
+                                    min_history=min_history, chunksize=chunksize,
+                                    return_codes=writer is not None, workers=workers)
+    for n_read, cleaned, codes, seconds in shards:
+        stats['sessions_in'] += n_read
+        stats['chunks'] += 1
+        stats['shards'].append({'rows': n_read, 'seconds': seconds,
+                                'rows_per_s': n_read / seconds if seconds else float('inf')})
+
+        if writer is not None:
+            writer.append(cleaned, codes)
+        cleaned.to_csv(output_path, mode='w' if header else 'a',
+                       header=header, index=False)
+        header = False
+        stats['sessions_out'] += len(cleaned)
+
+        new_users = ~cleaned.user_id.isin(seen_users) & ~cleaned.user_id.duplicated()
+        first_sessions.append(cleaned[new_users])
+        seen_users.update(cleaned.user_id[new_users])
+
+        log(f"Chunk {stats['chunks']}: {stats['sessions_in']} sessions read,",
+            f"{stats['sessions_out']} kept ({stats['shards'][-1]['rows_per_s']:,.0f} rows/s)",
+            end="\r")
+    log()
+    if writer is not None:
+        writer.close()
+
+    stats['users_out'] = len(seen_users)
+    if first_sessions:
+        behaviors_cf = pd.concat(first_sessions, ignore_index=True)
+    else:
+        behaviors_cf = pd.DataFrame(columns=BEHAVIORS_COLUMNS + ['length_history'])
+
+    return behaviors_cf, stats
+
+
+def user_article_interactions(behaviors_cf):
+    # user-article interactions for collaborative filtering: all but the last
+    # article of every history for training, the last article for testing.
+    # Users and articles get integer IDs (category codes of the train data)
+    # and test interactions with articles unknown to the train data are dropped.
+    hists = behaviors_cf.history.str.split(' ')
+
+    uai_train_df = pd.DataFrame({'user_id': behaviors_cf.user_id.to_numpy(),
+                                 'article_id': hists.str[:-1].to_numpy()})
+    uai_train_df = uai_train_df.explode('article_id', ignore_index=True).dropna()
+    uai_test_df = pd.DataFrame({'user_id': behaviors_cf.user_id.to_numpy(),
+                                'article_id': hists.str[-1].to_numpy()})
+
+    users = uai_train_df.user_id.astype('category')
+    articles = uai_train_df.article_id.astype('category')
+    uai_train_df['user_int_id'] = users.cat.codes
+    uai_train_df['article_int_id'] = articles.cat.codes
+
+    uai_test_df = uai_test_df[uai_test_df.article_id.isin(articles.cat.categories)].reset_index(drop=True)
+    uai_test_df['user_int_id'] = pd.Categorical(uai_test_df.user_id,
+                                                categories=users.cat.categories).codes
+    uai_test_df['article_int_id'] = pd.Categorical(uai_test_df.article_id,
+                                                   categories=articles.cat.categories).codes
+
+    return uai_train_df, uai_test_df
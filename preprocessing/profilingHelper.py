@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+import functools
+from contextlib import contextmanager
+
+
+# ## Peak memory
+# On Linux the peak RSS of the process (VmHWM) can be reset, so the peak of
+# every stage is measured separately. Elsewhere only the peak of the whole
+# process is available, which never decreases.
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024**2 if sys.platform == 'darwin' else maxrss / 1024
+
+
+class StageRecord:
+    # measurements of one (possibly nested) stage. `rows` and `items` can be
+    # set inside the with block, once they are known.
+
+    def __init__(self, name, rows=None, items=None, parent=None):
+        self.name = name
+        self.rows = rows
+        self.items = items
+        self.parent = parent
+        self.children = []
+        self.info = {}
+        self.wall_s = self.cpu_s = None
+        self.peak_rss_mb = 0.0
+
+    @property
+    def path(self):
+        return self.name if self.parent is None else f"{self.parent.path}/{self.name}"
+
+    def to_dict(self):
+        record = {'stage': self.name, 'wall_s': self.wall_s, 'cpu_s': self.cpu_s,
+                  'peak_rss_mb': self.peak_rss_mb}
+        for unit, n in (('rows', self.rows), ('items', self.items)):
+            if n is not None:
+                record[unit] = int(n)
+                record[f'{unit}_per_s'] = n / self.wall_s if self.wall_s else float('inf')
+        record.update(self.info)
+        if self.children:
+            record['stages'] = [child.to_dict() for child in self.children]
+
+        return record
+
+
+class Profiler:
+    # records wall time, CPU time, peak RSS and throughput of (nested) stages:
+    #
+    #   with profiler.stage("filter", rows=len(chunk)) as s:
+    #       ...
+    #
+    # or as a decorator with @profiler.profiled("filter"). Stages listed in
+    # `profile_stages` (or all of them with profile_stages='all') are run
+    # under cProfile, their stats are dumped to `profile_dir`. Progress
+    # output of the helpers goes through log(), so verbose=False silences it.
+
+    def __init__(self, verbose=True, profile_stages=(), profile_dir="profiles"):
+        self.verbose = verbose
+        self.profile_stages = profile_stages
+        self.profile_dir = profile_dir
+        self.stages = []
+        self._stack = []
+        self._cprofile_active = False
+
+    def log(self, *args, **kwargs):
+        if self.verbose:
+            print(*args, **kwargs)
+
+    def _should_profile(self, name):
+        if self._cprofile_active:
+            return False
+        return self.profile_stages == 'all' or name in self.profile_stages
+
+    @contextmanager
+    def stage(self, name, rows=None, items=None):
+        parent = self._stack[-1] if self._stack else None
+        record = StageRecord(name, rows=rows, items=items, parent=parent)
+        (parent.children if parent else self.stages).append(record)
+
+        # the peak of the enclosing stage up to here is kept, before the
+        # peak is reset for this stage
+        if parent is not None:
+            parent.peak_rss_mb = max(parent.peak_rss_mb, peak_rss_mb())
+        reset_peak_rss()
+
+        profile = cProfile.Profile() if self._should_profile(name) else None
+        self._stack.append(record)
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profile is not None:
+            self._cprofile_active = True
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+                self._cprofile_active = False
+            record.wall_s = time.perf_counter() - wall
+            record.cpu_s = time.process_time() - cpu
+            self._stack.pop()
+
+            record.peak_rss_mb = max(record.peak_rss_mb, peak_rss_mb())
+            if parent is not None:
+                parent.peak_rss_mb = max(parent.peak_rss_mb, record.peak_rss_mb)
+            if profile is not None:
+                self._dump_profile(record, profile)
+
+            self.log(self._format(record))
+
+    def profiled(self, name=None, rows=None):
+        # decorator version of stage(). `rows` is an optional function, which
+        # gets the same arguments as the decorated function.
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                n_rows = rows(*args, **kwargs) if rows is not None else None
+                with self.stage(name or func.__name__, rows=n_rows):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _dump_profile(self, record, profile):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, record.path.replace('/', '.') + '.prof')
+        profile.dump_stats(path)
+        record.info['profile'] = path
+        if self.verbose:
+            pstats.Stats(profile).sort_stats('cumulative').print_stats(15)
+
+    def _format(self, record):
+        depth = len(self._stack)
+        line = (f"{'  ' * depth}[{record.name}] {record.wall_s:.2f}s wall, {record.cpu_s:.2f}s cpu, "
+                f"{record.peak_rss_mb:,.0f} MB peak")
+        for unit, n in (('rows', record.rows), ('items', record.items)):
+            if n is not None and record.wall_s:
+                line += f", {n / record.wall_s:,.0f} {unit}/s"
+        for key, value in record.info.items():
+            if key != 'profile':
+                line += f", {key} {value}"
+
+        return line
+
+    def report(self):
+        return [record.to_dict() for record in self.stages]
+
+    def save_report(self, path_to_file):
+        with open(path_to_file, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+        return path_to_file
+
+    def reset(self):
+        self.stages = []
+
+
+# the profiler, which the helpers of this repository report to
+profiler = Profiler()
+
+
+def configure(verbose=None, profile_stages=None, profile_dir=None):
+    if verbose is not None:
+        profiler.verbose = verbose
+    if profile_stages is not None:
+        profiler.profile_stages = profile_stages
+    if profile_dir is not None:
+        profiler.profile_dir = profile_dir
+
+    return profiler
+
+
+def log(*args, **kwargs):
+    profiler.log(*args, **kwargs)
+
+
+def stage(name, rows=None, items=None):
+    return profiler.stage(name, rows=rows, items=items)
+
+
+def profiled(name=None, rows=None):
+    return profiler.profiled(name, rows=rows)
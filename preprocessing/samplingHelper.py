@@ -0,0 +1,55 @@
+import numpy as np
+
+from interactionHelper import has_interaction
+
+
+def popularity_weights(matrix, alpha=0.75):
+    # sampling probabilities proportional to (number of interactions)^alpha,
+    # as in the word2vec negative sampling. Articles without any interaction
+    # get the smallest possible weight instead of zero.
+    counts = np.bincount(matrix.indices, minlength=matrix.shape[1]).astype(np.float64)
+    weights = np.power(np.maximum(counts, 1), alpha)
+
+    return weights / weights.sum()
+
+
+def sample_negatives(matrix, users, num_negatives, num_items=None, p=None, seed=None,
+                     batch_size=10_000, max_rounds=100):
+    # draws `num_negatives` articles per user, which the user has not
+    # interacted with according to the CSR `matrix`. All candidates of a batch
+    # of users are drawn at once, collisions are found with has_interaction and
+    # only those are drawn again. `p` are (optional) sampling probabilities,
+    # e.g. from popularity_weights. Returns an int32 array of shape
+    # (len(users), num_negatives).
+    users = np.asarray(users, dtype=np.int32)
+    num_items = matrix.shape[1] if num_items is None else num_items
+    rng = seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+
+    if p is not None:
+        cdf = np.cumsum(p[:num_items])
+        cdf /= cdf[-1]
+
+    def draw(size):
+        if p is None:
+            return rng.integers(num_items, size=size, dtype=np.int32)
+        return np.searchsorted(cdf, rng.random(size), side='right').astype(np.int32)
+
+    negatives = np.empty((len(users), num_negatives), dtype=np.int32)
+    for start in range(0, len(users), batch_size):
+        batch_users = users[start:start+batch_size, None]
+        batch = draw((len(batch_users), num_negatives))
+
+        collisions = has_interaction(matrix, batch_users, batch)
+        for _ in range(max_rounds):
+            if not collisions.any():
+                break
+            rows, cols = np.nonzero(collisions)
+            batch[rows, cols] = draw(len(rows))
+            collisions[rows, cols] = has_interaction(matrix, batch_users[rows, 0], batch[rows, cols])
+        if collisions.any():
+            raise ValueError(f"could not sample negatives within {max_rounds} rounds, "
+                             "some users interacted with (almost) all articles")
+
+        negatives[start:start+batch_size] = batch
+
+    return negatives